@@ -0,0 +1,664 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import highCompute
+from highCompute import iter_sse_events
+
+
+def make_sse_stream(token_count, seed=0):
+    rng = random.Random(seed)
+    words = ["plan", "stage", "result", "étape", "шаг", "結果", "🚀", "synthesis", "\n"]
+    tokens = [rng.choice(words) + " " for _ in range(token_count)]
+    events = [b"data: " + json.dumps({"choices": [{"delta": {"content": token}}]}, ensure_ascii=False).encode("utf-8") + b"\n\n" for token in tokens]
+    events.append(b"data: [DONE]\n\n")
+    return tokens, b"".join(events)
+
+
+def split_into_chunks(data, max_chunk_size, seed=0):
+    rng = random.Random(seed)
+    chunks = []
+    position = 0
+    while position < len(data):
+        size = rng.randint(1, max_chunk_size)
+        chunks.append(data[position:position + size])
+        position += size
+    return chunks
+
+
+def legacy_parse(chunks):
+    tokens = []
+    for chunk_bytes in chunks:
+        try:
+            for line in chunk_bytes.decode("utf-8").splitlines():
+                if line.startswith("data:"):
+                    line_data = line[len("data:"):].strip()
+                    if line_data == "[DONE]":
+                        return tokens
+                    try:
+                        content = json.loads(line_data)["choices"][0]["delta"].get("content")
+                        if content:
+                            tokens.append(content)
+                    except json.JSONDecodeError:
+                        continue
+        except UnicodeDecodeError:
+            continue
+    return tokens
+
+
+def sse_parse(chunks):
+    tokens = []
+    for line_data in iter_sse_events(chunks):
+        if line_data == "[DONE]":
+            break
+        content = json.loads(line_data)["choices"][0]["delta"].get("content")
+        if content:
+            tokens.append(content)
+    return tokens
+
+
+def sse_events_only(chunks):
+    return sum(1 for _ in iter_sse_events(chunks))
+
+
+def run_sse_benchmark(args):
+    tokens, stream_bytes = make_sse_stream(args.tokens)
+    chunks = split_into_chunks(stream_bytes, args.max_chunk_size)
+    print(f"Synthetic stream: {len(tokens)} tokens, {len(stream_bytes) / 1024:.0f} KiB, {len(chunks)} chunks of 1..{args.max_chunk_size} bytes.")
+    for name, parse in (("legacy split", legacy_parse), ("SSEParser + json", sse_parse), ("SSEParser only", sse_events_only)):
+        best = None
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            result = parse(chunks)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        if isinstance(result, list):
+            lost = len(tokens) - len(result)
+            correctness = "exact" if result == tokens else f"{lost} tokens dropped or corrupted"
+        else:
+            correctness = f"{result} events"
+        print(f"{name:>18}: {len(tokens) / best:>12,.0f} tokens/s ({best * 1000:.1f} ms), {correctness}")
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 1024
+
+
+class MockLLMServer:
+    def __init__(self, host="127.0.0.1", port=0, ttft=0.05, token_latency=0.002, answer_tokens=40, fan_out=4, overlap=0, error_rate=0.0, slow_rate=0.0, slow_seconds=1.0, prefill_latency=0.0, ignore_n=False, reject_n=False, slots=0, seed=0):
+        self.ttft = ttft
+        self.slots = threading.BoundedSemaphore(slots) if slots > 0 else None
+        self.ignore_n = ignore_n
+        self.reject_n = reject_n
+        self.prefill_latency = prefill_latency
+        self.token_latency = token_latency
+        self.answer_tokens = answer_tokens
+        self.fan_out = fan_out
+        self.overlap = overlap
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_seconds = slow_seconds
+        self.rng = random.Random(seed)
+        self.failing = False
+        self.lock = threading.Lock()
+        self.reset_stats()
+        self.httpd = MockHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-llm-server", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = 0
+            self.in_flight = 0
+            self.peak_concurrency = 0
+            self.bytes_received = 0
+            self.bytes_sent = 0
+            self.prompt_chars = 0
+            self.max_prompt_chars = 0
+            self.prefix_reused_chars = 0
+            self.recent_prompts = deque(maxlen=64)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "peak_concurrency": self.peak_concurrency,
+                "bytes_received": self.bytes_received,
+                "bytes_sent": self.bytes_sent,
+                "prompt_chars": self.prompt_chars,
+                "max_prompt_chars": self.max_prompt_chars,
+                "prefix_reuse": self.prefix_reused_chars / self.prompt_chars if self.prompt_chars else 0.0,
+            }
+
+    def fail(self):
+        self.failing = True
+
+    def draw_fault(self):
+        with self.lock:
+            roll = self.rng.random()
+        if roll < self.error_rate:
+            return "error"
+        if roll < self.error_rate + self.slow_rate:
+            return "slow"
+        return None
+
+    def reply_for(self, payload):
+        prompt = payload["messages"][-1]["content"]
+        if "Reply with the number of the best candidate" in prompt:
+            return "1"
+        if "numbered list" in prompt:
+            parent = re.search(r'\(Level \d+\): "([^"]*)"', prompt)
+            if parent is None:
+                return "\n".join(f"{i}. Part {i} of the task" for i in range(1, self.fan_out + 1))
+            shared = range(self.fan_out - min(self.overlap, self.fan_out) + 1, self.fan_out + 1)
+            return "\n".join(f"{i}. Shared step {i} of the task" if i in shared else f"{i}. Part {i} of {parent.group(1)}" for i in range(1, self.fan_out + 1))
+        return " ".join(f"w{i % 100:02d}" for i in range(self.answer_tokens))
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if server.failing:
+                    self._unavailable()
+                    return
+                body = json.dumps({"object": "list", "data": [{"id": "mock-model", "object": "model"}]}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                raw_body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                fault = server.draw_fault()
+                if server.failing or fault == "error":
+                    self._unavailable()
+                    return
+                payload = json.loads(raw_body)
+                if server.reject_n and payload.get("n", 1) != 1:
+                    with server.lock:
+                        server.requests += 1
+                    self._bad_request("only n=1 is supported")
+                    return
+                with server.lock:
+                    server.requests += 1
+                    server.in_flight += 1
+                    server.peak_concurrency = max(server.peak_concurrency, server.in_flight)
+                    server.bytes_received += len(raw_body)
+                    prompt_text = "".join(f"<{message['role']}>{message['content']}" for message in payload["messages"])
+                    server.prompt_chars += len(prompt_text)
+                    server.max_prompt_chars = max(server.max_prompt_chars, len(prompt_text))
+                    server.prefix_reused_chars += max((len(os.path.commonprefix([prompt_text, previous])) for previous in server.recent_prompts), default=0)
+                    server.recent_prompts.append(prompt_text)
+                sent = 0
+                if server.slots is not None:
+                    server.slots.acquire()
+                try:
+                    if fault == "slow":
+                        time.sleep(server.slow_seconds)
+                    time.sleep(server.prefill_latency * len(prompt_text) / 4000)
+                    reply = server.reply_for(payload)
+                    sent = self._stream(reply) if payload.get("stream") else self._complete(payload, reply)
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+                finally:
+                    if server.slots is not None:
+                        server.slots.release()
+                    with server.lock:
+                        server.in_flight -= 1
+                        server.bytes_sent += sent
+
+            def _bad_request(self, message):
+                body = json.dumps({"error": {"message": message}}).encode("utf-8")
+                self.send_response(400)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _unavailable(self):
+                body = b'{"error": {"message": "Replica unavailable"}}'
+                self.send_response(503)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _complete(self, payload, reply):
+                tokens = reply.split(" ")
+                time.sleep(server.ttft + server.token_latency * len(tokens))
+                choices = [{"index": i, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"} for i in range(1 if server.ignore_n else payload.get("n", 1))]
+                body = json.dumps({"object": "chat.completion", "choices": choices, "usage": {"prompt_tokens": sum(len(message["content"]) for message in payload["messages"]) // 4, "completion_tokens": len(tokens) * len(choices)}}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return len(body)
+
+            def _stream(self, reply):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                sent = 0
+                time.sleep(server.ttft)
+                for token in re.findall(r"\S+\s*|\n", reply):
+                    event = b"data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": token}}]}).encode("utf-8") + b"\n\n"
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+                    self.wfile.flush()
+                    sent += len(event)
+                    time.sleep(server.token_latency)
+                done = b"data: [DONE]\n\n"
+                self.wfile.write(b"%x\r\n%s\r\n0\r\n\r\n" % (len(done), done))
+                self.wfile.flush()
+                return sent + len(done)
+
+        return Handler
+
+
+def start_mock_server(args, port=0):
+    return MockLLMServer(port=port, ttft=args.ttft, token_latency=args.token_latency, answer_tokens=args.answer_tokens, fan_out=args.fan_out, overlap=args.overlap, error_rate=args.error_rate, slow_rate=args.slow_rate, slow_seconds=args.slow_seconds, prefill_latency=args.prefill_latency, ignore_n=args.ignore_n, reject_n=args.reject_n, slots=args.slots).start()
+
+
+def combine_stats(servers):
+    stats = [server.stats() for server in servers]
+    prompt_chars = sum(entry["prompt_chars"] for entry in stats)
+    combined = {key: sum(entry[key] for entry in stats) for key in ("requests", "peak_concurrency", "bytes_received", "bytes_sent", "prompt_chars")}
+    combined["max_prompt_chars"] = max(entry["max_prompt_chars"] for entry in stats)
+    combined["prefix_reuse"] = sum(entry["prefix_reuse"] * entry["prompt_chars"] for entry in stats) / prompt_chars if prompt_chars else 0.0
+    combined["replica_requests"] = [entry["requests"] for entry in stats]
+    return combined
+
+
+def run_pipeline_benchmark(args):
+    servers = [start_mock_server(args) for _ in range(args.replicas)]
+    server = servers[0]
+    highCompute.LOCAL_API_ENDPOINT = server.url
+    if args.replicas > 1:
+        highCompute.LLM_ENDPOINTS = [highCompute.Endpoint(replica.url) for replica in servers]
+    if args.max_parallel:
+        highCompute.MAX_PARALLEL_REQUESTS = args.max_parallel
+    highCompute.SPECULATIVE_DISPATCH = not args.no_speculative
+    if not args.cache:
+        highCompute.response_cache = None
+    if args.checkpoints:
+        highCompute.CHECKPOINT_KEEP_COMPLETED = True
+    else:
+        highCompute.checkpoint_store = None
+    if args.no_dedup:
+        highCompute.DEDUP_SUBTASKS = False
+    if args.retries is not None:
+        highCompute.RETRY_ATTEMPTS = args.retries
+    if args.hedge_percentile is not None:
+        highCompute.HEDGE_PERCENTILE = args.hedge_percentile
+    if args.samples is not None:
+        highCompute.SAMPLE_COUNT = args.samples
+    if args.sample_selection is not None:
+        highCompute.SAMPLE_SELECTION = args.sample_selection
+    if args.synthesis_batch_tokens is not None:
+        highCompute.SYNTHESIS_BATCH_TOKENS = args.synthesis_batch_tokens
+    print(f"Mock backend at {', '.join(replica.url for replica in servers)}: TTFT {args.ttft * 1000:.0f}ms, prefill {args.prefill_latency * 1000:.0f}ms/1k prompt tokens, {args.token_latency * 1000:.1f}ms/token, {args.answer_tokens} tokens per answer, fan-out {args.fan_out}, overlap {args.overlap}.")
+    sampling = f"{highCompute.SAMPLE_COUNT} samples per {'/'.join(sorted(highCompute.SAMPLE_KINDS))} call picked by {highCompute.SAMPLE_SELECTION}" if highCompute.SAMPLE_COUNT > 1 else "one sample per call"
+    print(f"Engine: LLM_MAX_PARALLEL_REQUESTS={highCompute.MAX_PARALLEL_REQUESTS}, speculative dispatch {'on' if highCompute.SPECULATIVE_DISPATCH else 'off'}, response cache {'on' if highCompute.response_cache else 'off'}, checkpoints {'on' if highCompute.checkpoint_store else 'off'}, subtask deduplication {'on' if highCompute.DEDUP_SUBTASKS else 'off'}, {highCompute.RETRY_ATTEMPTS} retries, hedging {f'at p{highCompute.HEDGE_PERCENTILE:g}' if highCompute.HEDGE_PERCENTILE > 0 else 'off'}, synthesis batch {f'{highCompute.SYNTHESIS_BATCH_TOKENS} tokens' if highCompute.SYNTHESIS_BATCH_TOKENS > 0 else 'off'}, {sampling}.")
+    print(f"{'level':>8} {'wall s':>8} {'first tok s':>11} {'tokens':>7} {'requests':>9} {'peak conc':>9} {'KiB to backend':>14} {'KiB from backend':>16} {'prefix reuse':>12} {'max prompt tok':>14} {'failed calls':>12}")
+    results = []
+    if args.fail_replica_after:
+        failure_timer = threading.Timer(args.fail_replica_after, server.fail)
+        failure_timer.daemon = True
+        failure_timer.start()
+    try:
+        for level in args.levels:
+            for run in range(args.repeat):
+                for replica in servers:
+                    replica.reset_stats()
+                result = highCompute.run_compute(f"Benchmark task {0 if args.checkpoints else run}: design a reliable data pipeline", level, history=[[f"Earlier question {turn}", "Earlier answer " * (args.history_words // args.history_turns)] for turn in range(args.history_turns)] if args.history_words else None, token_budget=args.token_budget, time_budget=args.time_budget)
+                stats = combine_stats(servers)
+                row = {"level": level, "run": run, "seconds": result["seconds"], "first_token_seconds": result["first_token_seconds"], "tokens": result["trace"]["prompt_tokens"] + result["trace"]["completion_tokens"], "budget": result["budget"], "failed_calls": sum(kind["errors"] for kind in result["trace"]["by_kind"].values()), **stats}
+                results.append(row)
+                print(f"{level:>8} {row['seconds']:>8.2f} {row['first_token_seconds'] or 0:>11.2f} {row['tokens']:>7} {row['requests']:>9} {row['peak_concurrency']:>9} {row['bytes_received'] / 1024:>14.1f} {row['bytes_sent'] / 1024:>16.1f} {row['prefix_reuse']:>12.0%} {row['max_prompt_chars'] // 4:>14} {row['failed_calls']:>12}{'  per replica: ' + '/'.join(map(str, row['replica_requests'])) if args.replicas > 1 else ''}")
+    finally:
+        for replica in servers:
+            replica.stop()
+    if args.repeat > 1:
+        for level in args.levels:
+            walls = sorted(row["seconds"] for row in results if row["level"] == level)
+            print(f"{level:>8} wall over {len(walls)} runs: median {walls[len(walls) // 2]:.2f}s, p90 {walls[min(len(walls) - 1, int(len(walls) * 0.9))]:.2f}s, max {walls[-1]:.2f}s.")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.json}.")
+    return results
+
+
+def legacy_chat_stream(message, history):
+    history.append([message, ""])
+    yield history, "", "[Status] Processing request..."
+    full_response = ""
+    for chunk in highCompute.call_llm(message, chat_history_gradio=history[:-1], stream=True, kind="direct", role="direct answer"):
+        full_response += chunk
+        history[-1][1] = full_response
+        yield history, "", "[Status] Sending request directly to LLM..."
+    yield history, "", ""
+
+
+def measure_ui_stream(frames):
+    stats = {"frames": 0, "full_bytes": 0, "diff_bytes": 0}
+    previous = None
+    started = time.perf_counter()
+    cpu_started = time.thread_time()
+    for history, text, status in frames:
+        stats["frames"] += 1
+        stats["full_bytes"] += len(json.dumps([history, text, status], ensure_ascii=False).encode("utf-8"))
+        answer = history[-1][1]
+        if previous is None or len(history) != previous[0]:
+            operations = [[["replace", [], history]], [], [["replace", [], status]]]
+        else:
+            answer_operations = [] if answer == previous[1] else [["append", [len(history) - 1, 1], answer[len(previous[1]):]]] if answer.startswith(previous[1]) else [["replace", [len(history) - 1, 1], answer]]
+            operations = [answer_operations, [], [] if status == previous[2] else [["replace", [], status]]]
+        stats["diff_bytes"] += len(json.dumps({"msg": "process_generating", "output": {"data": operations}}, ensure_ascii=False).encode("utf-8"))
+        previous = (len(history), answer, status)
+    stats["seconds"] = time.perf_counter() - started
+    stats["cpu_seconds"] = time.thread_time() - cpu_started
+    stats["answer_chars"] = len(previous[1]) if previous else 0
+    return stats
+
+
+def run_ui_benchmark(args):
+    server = start_mock_server(args)
+    highCompute.LOCAL_API_ENDPOINT = server.url
+    highCompute.response_cache = None
+    if args.frame_rate is not None:
+        highCompute.UI_FRAME_RATE = args.frame_rate
+    history = [[f"Earlier question {turn}", "Earlier answer " * (args.history_words // max(1, args.history_turns))] for turn in range(args.history_turns)] if args.history_words else []
+    print(f"Mock backend at {server.url}: {args.answer_tokens} tokens per answer, {args.token_latency * 1000:.1f}ms/token, {len(history)} earlier turns in the chat.")
+    try:
+        rows = [("per-token (legacy)", measure_ui_stream(legacy_chat_stream("Write a long answer", [list(turn) for turn in history])))]
+        rows.append((f"coalesced {highCompute.UI_FRAME_RATE:g} fps", measure_ui_stream(highCompute.chat_interface_logic("Write a long answer", [list(turn) for turn in history], "Low", 0.7, 1.0, 0))))
+    finally:
+        server.stop()
+    print(f"{'mode':>20} {'frames':>7} {'answer chars':>12} {'KiB full updates':>16} {'KiB diff updates':>16} {'CPU s':>7} {'wall s':>7}")
+    for name, stats in rows:
+        print(f"{name:>20} {stats['frames']:>7} {stats['answer_chars']:>12} {stats['full_bytes'] / 1024:>16.1f} {stats['diff_bytes'] / 1024:>16.1f} {stats['cpu_seconds']:>7.2f} {stats['seconds']:>7.2f}")
+    legacy, coalesced = rows[0][1], rows[1][1]
+    print(f"Coalescing sends {legacy['full_bytes'] / max(1, coalesced['full_bytes']):.0f}x fewer bytes as full updates and {legacy['diff_bytes'] / max(1, coalesced['diff_bytes']):.1f}x fewer as Gradio 4 diffs.")
+
+
+def run_load_benchmark(args):
+    server = start_mock_server(args)
+    highCompute.LOCAL_API_ENDPOINT = server.url
+    highCompute.response_cache = None
+    highCompute.checkpoint_store = None
+    scheduler_settings = [0, args.max_in_flight] if args.compare else [args.max_in_flight]
+    print(f"Mock backend at {server.url}: {args.slots or 'unlimited'} slot(s), TTFT {args.ttft * 1000:.0f}ms, {args.token_latency * 1000:.1f}ms/token, {args.answer_tokens} tokens per answer, fan-out {args.fan_out}.")
+    print(f"Load: {args.background_users} user(s) running {args.background_level} back to back, {args.interactive_users} user(s) sending {args.interactive_requests} Low request(s) each, {args.think_time:g}s apart.")
+    print(f"{'scheduler':>16} {'Low first tok p50':>17} {'p95':>7} {'max':>7} {args.background_level + ' done':>10} {'queued interactive/normal/background':>36} {'wait p95 s':>18}")
+    try:
+        for max_in_flight in scheduler_settings:
+            highCompute.request_scheduler = highCompute.RequestScheduler(max_in_flight, args.interactive_reserve)
+            stop = threading.Event()
+            first_tokens = []
+            background_done = []
+
+            def background_user(user):
+                run = 0
+                while not stop.is_set():
+                    highCompute.run_compute(f"Background task {user}.{run}: design a reliable data pipeline", args.background_level)
+                    background_done.append(user)
+                    run += 1
+
+            def interactive_user(user):
+                for run in range(args.interactive_requests):
+                    time.sleep(args.think_time)
+                    result = highCompute.run_compute(f"Quick question {user}.{run}", "Low")
+                    first_tokens.append(result["first_token_seconds"] or result["seconds"])
+
+            background = [threading.Thread(target=background_user, args=(user,), daemon=True) for user in range(args.background_users)]
+            interactive = [threading.Thread(target=interactive_user, args=(user,), daemon=True) for user in range(args.interactive_users)]
+            for thread in background + interactive:
+                thread.start()
+            for thread in interactive:
+                thread.join()
+            stop.set()
+            for thread in background:
+                thread.join()
+            first_tokens.sort()
+            stats = highCompute.request_scheduler.stats()["classes"]
+            label = f"{max_in_flight} in flight" if max_in_flight else "off"
+            queued = "/".join(str(stats[name]["peak_queued"]) for name in highCompute.PRIORITY_CLASSES)
+            waits = "/".join(f"{stats[name]['p95_wait_seconds']:.2f}" for name in highCompute.PRIORITY_CLASSES)
+            print(f"{label:>16} {first_tokens[len(first_tokens) // 2]:>17.2f} {first_tokens[min(len(first_tokens) - 1, int(len(first_tokens) * 0.95))]:>7.2f} {first_tokens[-1]:>7.2f} {len(background_done):>10} {queued:>36} {waits:>18}")
+    finally:
+        server.stop()
+
+
+def stream_api_request(host, port, level, prompt):
+    connection = http.client.HTTPConnection(host, port, timeout=600)
+    body = json.dumps({"model": f"{highCompute.SERVER_MODEL_PREFIX}-{level.lower()}", "stream": True, "messages": [{"role": "user", "content": prompt}]})
+    started = time.perf_counter()
+    first_token = None
+    answer_chars = 0
+    try:
+        connection.request("POST", "/v1/chat/completions", body=body, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        if response.status != 200:
+            raise RuntimeError(f"HTTP {response.status}: {response.read()[:200]!r}")
+        for data in iter_sse_events(iter(lambda: response.read1(65536), b"")):
+            if data == "[DONE]":
+                break
+            choices = json.loads(data).get("choices") or [{}]
+            content = choices[0].get("delta", {}).get("content")
+            if content:
+                first_token = first_token or time.perf_counter() - started
+                answer_chars += len(content)
+    finally:
+        connection.close()
+    return first_token, time.perf_counter() - started, answer_chars
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_for_http(port, path, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", path)
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def process_threads(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("Threads:"))
+    except OSError:
+        return 0
+
+
+def run_server_benchmark(args):
+    backend_port, server_port = free_port(), free_port()
+    mock_args = ["--ttft", str(args.ttft), "--token-latency", str(args.token_latency), "--answer-tokens", str(args.answer_tokens), "--fan-out", str(args.fan_out), "--slots", str(args.slots)]
+    env = dict(os.environ, LLM_API_ENDPOINT=f"http://127.0.0.1:{backend_port}/v1/chat/completions", LLM_CACHE_ENABLED="false", LLM_CHECKPOINTS_ENABLED="false", LLM_LOG_LEVEL="WARNING", LLM_HTTP_POOL_SIZE=str(max(args.clients) * highCompute.MAX_PARALLEL_REQUESTS))
+    if args.max_in_flight is not None:
+        env["LLM_SCHEDULER_MAX_IN_FLIGHT"] = str(args.max_in_flight)
+    here = os.path.dirname(os.path.abspath(__file__))
+    processes = [
+        subprocess.Popen([sys.executable, os.path.join(here, "benchmark.py"), "mock-server", "--port", str(backend_port)] + mock_args, stdout=subprocess.DEVNULL),
+        subprocess.Popen([sys.executable, os.path.join(here, "highCompute.py"), "serve", "--port", str(server_port), "--workers", str(args.workers)], env=env),
+    ]
+    try:
+        wait_for_http(backend_port, "/v1/models")
+        wait_for_http(server_port, "/v1/models")
+        print(f"Mock backend on port {backend_port} and API server on port {server_port} in separate processes: {args.slots or 'unlimited'} backend slot(s), TTFT {args.ttft * 1000:.0f}ms, {args.token_latency * 1000:.1f}ms/token, {args.answer_tokens} tokens per answer, {args.workers} compute workers, scheduler {args.max_in_flight or 'off'}.")
+        print(f"{'level':>8} {'clients':>8} {'requests':>9} {'req/s':>7} {'first tok p50':>13} {'p95':>7} {'latency p50':>11} {'p95':>7} {'errors':>7} {'server threads':>14}")
+        for level in args.levels:
+            for clients in args.clients:
+                requests_per_client = max(1, args.requests // clients)
+                results = []
+                errors = []
+                peak_threads = 0
+
+                def client(user):
+                    for run in range(requests_per_client):
+                        try:
+                            results.append(stream_api_request("127.0.0.1", server_port, level, f"Request {user}.{run}: design a reliable data pipeline"))
+                        except Exception as e:
+                            errors.append(e)
+
+                threads = [threading.Thread(target=client, args=(user,), daemon=True) for user in range(clients)]
+                started = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                while any(thread.is_alive() for thread in threads):
+                    peak_threads = max(peak_threads, process_threads(processes[1].pid))
+                    time.sleep(0.05)
+                wall = time.perf_counter() - started
+                first_tokens = sorted(result[0] or result[1] for result in results)
+                latencies = sorted(result[1] for result in results)
+                p50 = lambda values: values[len(values) // 2] if values else 0.0
+                p95 = lambda values: values[min(len(values) - 1, int(len(values) * 0.95))] if values else 0.0
+                print(f"{level:>8} {clients:>8} {len(results):>9} {len(results) / wall:>7.1f} {p50(first_tokens):>13.2f} {p95(first_tokens):>7.2f} {p50(latencies):>11.2f} {p95(latencies):>7.2f} {len(errors):>7} {peak_threads:>14}")
+                if errors:
+                    print(f"         first error: {errors[0]}")
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+def run_mock_server(args):
+    server = start_mock_server(args, port=args.port)
+    print(f"Mock OpenAI-compatible backend listening at {server.url} (Ctrl+C to stop).")
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+def add_mock_arguments(parser):
+    parser.add_argument("--ttft", type=float, default=0.05, help="Mock time to first token in seconds.")
+    parser.add_argument("--token-latency", type=float, default=0.002, help="Mock seconds per generated token.")
+    parser.add_argument("--answer-tokens", type=int, default=40, help="Tokens in every non-decomposition answer.")
+    parser.add_argument("--fan-out", type=int, default=4, help="Items in every scripted numbered-list decomposition.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of chat requests answered with 503.")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Fraction of chat requests delayed by --slow-seconds.")
+    parser.add_argument("--slow-seconds", type=float, default=1.0, help="Extra delay of a slow request.")
+    parser.add_argument("--prefill-latency", type=float, default=0.0, help="Mock seconds of prefill per 1000 prompt tokens.")
+    parser.add_argument("--ignore-n", action="store_true", help="Answer every request with one choice, like servers without support for the n parameter.")
+    parser.add_argument("--reject-n", action="store_true", help="Reject requests with n > 1 with HTTP 400, like llama.cpp.")
+    parser.add_argument("--slots", type=int, default=0, help="Requests the mock decodes at once; later ones wait, like a server with a fixed number of slots (0 = unlimited).")
+    parser.add_argument("--overlap", type=int, default=0, help="How many items of every lower-level decomposition are the same across all stages.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Performance benchmarks for highCompute.py.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    sse_parser = subparsers.add_parser("sse", help="Parse a large synthetic SSE stream split into random TCP-sized chunks.")
+    sse_parser.add_argument("--tokens", type=int, default=200000)
+    sse_parser.add_argument("--max-chunk-size", type=int, default=1500)
+    sse_parser.add_argument("--repeat", type=int, default=3)
+    sse_parser.set_defaults(run=run_sse_benchmark)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="Run compute levels end-to-end against a local mock backend.")
+    pipeline_parser.add_argument("--levels", nargs="+", default=["Low", "Medium", "High"], choices=list(highCompute.COMPUTE_LEVELS))
+    pipeline_parser.add_argument("--repeat", type=int, default=1)
+    pipeline_parser.add_argument("--max-parallel", type=int, default=0, help="Override LLM_MAX_PARALLEL_REQUESTS.")
+    pipeline_parser.add_argument("--no-speculative", action="store_true", help="Disable speculative dispatch during decomposition.")
+    pipeline_parser.add_argument("--retries", type=int, default=None, help="Override LLM_RETRIES.")
+    pipeline_parser.add_argument("--hedge-percentile", type=float, default=None, help="Override LLM_HEDGE_PERCENTILE (0 disables hedging).")
+    pipeline_parser.add_argument("--no-dedup", action="store_true", help="Solve repeated subtasks separately instead of once per run.")
+    pipeline_parser.add_argument("--samples", type=int, default=None, help="Override LLM_SAMPLES (samples per direct answer and subtask solve).")
+    pipeline_parser.add_argument("--sample-selection", choices=["vote", "judge"], default=None, help="Override LLM_SAMPLE_SELECTION.")
+    pipeline_parser.add_argument("--synthesis-batch-tokens", type=int, default=None, help="Override LLM_SYNTHESIS_BATCH_TOKENS (0 synthesizes all results in one pass).")
+    pipeline_parser.add_argument("--cache", action="store_true", help="Keep the response cache enabled between runs.")
+    pipeline_parser.add_argument("--checkpoints", action="store_true", help="Keep tree checkpoints, also of completed runs, and repeat the same task, so later runs resume from earlier ones.")
+    pipeline_parser.add_argument("--token-budget", type=int, default=None, help="Per-request token budget (default: LLM_TOKEN_BUDGET).")
+    pipeline_parser.add_argument("--time-budget", type=float, default=None, help="Per-request time budget in seconds (default: LLM_TIME_BUDGET).")
+    pipeline_parser.add_argument("--history-words", type=int, default=0, help="Add earlier chat history of this many words.")
+    pipeline_parser.add_argument("--history-turns", type=int, default=4, help="Number of turns the earlier chat history is split into.")
+    pipeline_parser.add_argument("--replicas", type=int, default=1, help="Start this many mock backends and route requests across them.")
+    pipeline_parser.add_argument("--fail-replica-after", type=float, default=0, help="Make the first mock backend answer 503 after this many seconds.")
+    pipeline_parser.add_argument("--json", help="Also write the results to this JSON file.")
+    add_mock_arguments(pipeline_parser)
+    pipeline_parser.set_defaults(run=run_pipeline_benchmark)
+
+    ui_parser = subparsers.add_parser("ui", help="Stream one long Low answer through the chat handler and measure the interface updates.")
+    ui_parser.add_argument("--frame-rate", type=float, default=None, help="Override LLM_UI_FRAME_RATE.")
+    ui_parser.add_argument("--history-words", type=int, default=4000, help="Words of earlier chat history shown in the chat.")
+    ui_parser.add_argument("--history-turns", type=int, default=10, help="Number of turns the earlier chat history is split into.")
+    add_mock_arguments(ui_parser)
+    ui_parser.set_defaults(run=run_ui_benchmark, answer_tokens=4096)
+
+    load_parser = subparsers.add_parser("load", help="Measure Low latency while other users run large queries against one backend.")
+    load_parser.add_argument("--background-users", type=int, default=2, help="Users running --background-level queries back to back.")
+    load_parser.add_argument("--background-level", default="High", choices=list(highCompute.COMPUTE_LEVELS))
+    load_parser.add_argument("--interactive-users", type=int, default=4, help="Users sending Low requests.")
+    load_parser.add_argument("--interactive-requests", type=int, default=10, help="Low requests per interactive user.")
+    load_parser.add_argument("--think-time", type=float, default=0.3, help="Seconds between the Low requests of one user.")
+    load_parser.add_argument("--max-in-flight", type=int, default=4, help="Scheduler limit (LLM_SCHEDULER_MAX_IN_FLIGHT); 0 disables the scheduler.")
+    load_parser.add_argument("--interactive-reserve", type=int, default=1, help="Override LLM_SCHEDULER_INTERACTIVE_RESERVE.")
+    load_parser.add_argument("--compare", action="store_true", help="Also run the same load without the scheduler first.")
+    add_mock_arguments(load_parser)
+    load_parser.set_defaults(run=run_load_benchmark, slots=4, answer_tokens=200)
+
+    server_parser = subparsers.add_parser("server", help="Measure the throughput of the OpenAI-compatible API server against a local mock backend.")
+    server_parser.add_argument("--levels", nargs="+", default=["Low", "Medium"], choices=list(highCompute.COMPUTE_LEVELS))
+    server_parser.add_argument("--clients", nargs="+", type=int, default=[1, 16, 64, 256], help="Concurrent streaming clients to measure.")
+    server_parser.add_argument("--requests", type=int, default=256, help="Requests per measurement, split across the clients.")
+    server_parser.add_argument("--workers", type=int, default=highCompute.SERVER_WORKERS, help="Override LLM_SERVER_WORKERS.")
+    server_parser.add_argument("--max-in-flight", type=int, default=None, help="Override LLM_SCHEDULER_MAX_IN_FLIGHT.")
+    add_mock_arguments(server_parser)
+    server_parser.set_defaults(run=run_server_benchmark, answer_tokens=100)
+
+    mock_parser = subparsers.add_parser("mock-server", help="Run the mock OpenAI-compatible backend on its own.")
+    mock_parser.add_argument("--port", type=int, default=8080)
+    add_mock_arguments(mock_parser)
+    mock_parser.set_defaults(run=run_mock_server)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
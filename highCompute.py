@@ -1,13 +1,29 @@
-import gradio as gr
 import requests
+from requests.adapters import HTTPAdapter
+import asyncio
+import argparse
 import json
+import logging
+import math
 import os
 import re
 from dotenv import load_dotenv
 import time
+import queue
+import threading
+import hashlib
+import random
+import codecs
+import contextvars
+import uuid
+import sqlite3
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 load_dotenv()
 
+logger = logging.getLogger("highCompute")
+
 DEFAULT_ENDPOINT = "http://127.0.0.1:8080/v1/chat/completions"
 DEFAULT_LLM_MODEL = "local-model"
 DEFAULT_API_KEY = None
@@ -15,8 +31,1128 @@ DEFAULT_API_KEY = None
 LOCAL_API_ENDPOINT = os.getenv("LLM_API_ENDPOINT", DEFAULT_ENDPOINT)
 LLM_MODEL = os.getenv("LLM_MODEL", DEFAULT_LLM_MODEL)
 LLM_API_KEY = os.getenv("LLM_API_KEY", DEFAULT_API_KEY)
+MAX_PARALLEL_REQUESTS = max(1, int(os.getenv("LLM_MAX_PARALLEL_REQUESTS", "4")))
+HTTP_POOL_SIZE = max(1, int(os.getenv("LLM_HTTP_POOL_SIZE", "32")))
+HTTP2_ENABLED = os.getenv("LLM_HTTP2", "false").lower() in ("1", "true", "yes")
+CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "36000"))
+CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024"))
+CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))
+CACHE_PATH = os.getenv("LLM_CACHE_PATH", "")
+CACHE_MAX_DISK_MB = float(os.getenv("LLM_CACHE_MAX_DISK_MB", "256"))
+CACHE_KINDS = {kind.strip() for kind in os.getenv("LLM_CACHE_KINDS", "decompose,synthesis,summary").split(",") if kind.strip()}
+CACHE_MAX_TEMPERATURE = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", "0.5"))
+SPECULATIVE_DISPATCH = os.getenv("LLM_SPECULATIVE_DISPATCH", "true").lower() in ("1", "true", "yes")
+LOG_LEVEL = os.getenv("LLM_LOG_LEVEL", "INFO").upper()
+TRACE_DIR = os.getenv("LLM_TRACE_DIR", "")
+HISTORY_TOKEN_BUDGET = int(os.getenv("LLM_HISTORY_TOKEN_BUDGET", "0"))
+HISTORY_SUMMARIZE = os.getenv("LLM_HISTORY_SUMMARIZE", "false").lower() in ("1", "true", "yes")
+PREFIX_CACHE_HINT = os.getenv("LLM_PREFIX_CACHE_HINT", "none").lower()
+LLM_ENDPOINTS = os.getenv("LLM_API_ENDPOINTS", "")
+HEALTH_CHECK_INTERVAL = float(os.getenv("LLM_HEALTH_CHECK_INTERVAL", "10"))
+ENDPOINT_COOLDOWN = float(os.getenv("LLM_ENDPOINT_COOLDOWN", "30"))
+CHECKPOINTS_ENABLED = os.getenv("LLM_CHECKPOINTS_ENABLED", "true").lower() in ("1", "true", "yes")
+CHECKPOINT_PATH = os.getenv("LLM_CHECKPOINT_PATH", "")
+CHECKPOINT_MAX_TURNS = int(os.getenv("LLM_CHECKPOINT_MAX_TURNS", "256"))
+CHECKPOINT_KEEP_COMPLETED = os.getenv("LLM_CHECKPOINT_KEEP_COMPLETED", "false").lower() in ("1", "true", "yes")
+TOKEN_BUDGET = int(os.getenv("LLM_TOKEN_BUDGET", "0"))
+TIME_BUDGET = float(os.getenv("LLM_TIME_BUDGET", "0"))
+MAX_SUBTASKS = int(os.getenv("LLM_MAX_SUBTASKS", "0"))
+ULTRA_FAN_OUTS = [int(limit) or None for limit in os.getenv("LLM_ULTRA_FAN_OUTS", "6,4,3").split(",") if limit.strip()] or [None, None, None]
+DEDUP_SUBTASKS = os.getenv("LLM_DEDUP_SUBTASKS", "true").lower() in ("1", "true", "yes")
+RETRY_ATTEMPTS = max(0, int(os.getenv("LLM_RETRIES", "2")))
+RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", "0.5"))
+RETRY_MAX_BACKOFF = float(os.getenv("LLM_RETRY_MAX_BACKOFF", "8"))
+HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0"))
+HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WINDOW = 200
+SAMPLE_COUNT = max(1, int(os.getenv("LLM_SAMPLES", "1")))
+SAMPLE_KINDS = {kind.strip() for kind in os.getenv("LLM_SAMPLE_KINDS", "direct,solve").split(",") if kind.strip()}
+SAMPLE_SELECTION = os.getenv("LLM_SAMPLE_SELECTION", "vote").lower()
+SYNTHESIS_BATCH_TOKENS = int(os.getenv("LLM_SYNTHESIS_BATCH_TOKENS", "0"))
+SCHEDULER_MAX_IN_FLIGHT = int(os.getenv("LLM_SCHEDULER_MAX_IN_FLIGHT", "0"))
+SCHEDULER_INTERACTIVE_RESERVE = int(os.getenv("LLM_SCHEDULER_INTERACTIVE_RESERVE", "1"))
+SCHEDULER_WINDOW = 1000
+SERVER_HOST = os.getenv("LLM_SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("LLM_SERVER_PORT", "8000"))
+SERVER_WORKERS = max(1, int(os.getenv("LLM_SERVER_WORKERS", "64")))
+SERVER_API_KEY = os.getenv("LLM_SERVER_API_KEY", "")
+SERVER_DEFAULT_LEVEL = os.getenv("LLM_SERVER_DEFAULT_LEVEL", "Low")
+SERVER_MODEL_PREFIX = "highcompute"
+UI_CONCURRENCY = int(os.getenv("LLM_UI_CONCURRENCY", "1"))
+UI_FRAME_RATE = float(os.getenv("LLM_UI_FRAME_RATE", "20"))
+UI_FLUSH_BYTES = int(os.getenv("LLM_UI_FLUSH_BYTES", "0"))
+ANSWER_TOKENS_ESTIMATE = 512
+FAN_OUT_ESTIMATE = 4
+
+
+class _HttpxResponse:
+    def __init__(self, httpx, response):
+        self.httpx = httpx
+        self.response = response
+        self.encoding = response.encoding
+        self.apparent_encoding = "utf-8"
+
+    def _translate(self, e):
+        if isinstance(e, self.httpx.TimeoutException):
+            return requests.exceptions.Timeout(str(e))
+        if isinstance(e, self.httpx.HTTPStatusError):
+            return requests.exceptions.HTTPError(str(e), response=e.response)
+        return requests.exceptions.RequestException(str(e))
+
+    def raise_for_status(self):
+        try:
+            self.response.raise_for_status()
+        except self.httpx.HTTPError as e:
+            self.response.close()
+            raise self._translate(e) from e
+
+    def json(self):
+        return json.loads(self.text)
+
+    @property
+    def text(self):
+        try:
+            return self.response.read().decode(self.encoding or "utf-8", errors="replace")
+        except self.httpx.HTTPError as e:
+            raise self._translate(e) from e
+
+    def iter_content(self, chunk_size=None):
+        try:
+            yield from self.response.iter_bytes(chunk_size)
+        except self.httpx.HTTPError as e:
+            raise self._translate(e) from e
+
+    def close(self):
+        self.response.close()
+
+
+class HttpTransport:
+    def __init__(self, pool_size=HTTP_POOL_SIZE, http2=HTTP2_ENABLED, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        self.timeout = (connect_timeout, read_timeout)
+        self.httpx = None
+        if http2:
+            try:
+                import httpx
+                self.httpx = httpx
+                self.client = httpx.Client(
+                    http2=True,
+                    limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                    timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                )
+                logger.info(f"HTTP transport: httpx with HTTP/2, pool size {pool_size}.")
+            except ImportError:
+                logger.warning("LLM_HTTP2 is enabled but 'httpx[http2]' is not installed. Falling back to HTTP/1.1 keep-alive.")
+        if self.httpx is None:
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+            logger.info(f"HTTP transport: requests keep-alive session, pool size {pool_size}.")
+
+    def post(self, url, headers, data, stream=False):
+        if self.httpx is None:
+            return self.session.post(url, headers=headers, data=data, timeout=self.timeout, stream=stream)
+        try:
+            request = self.client.build_request("POST", url, headers=headers, content=data)
+            return _HttpxResponse(self.httpx, self.client.send(request, stream=stream))
+        except self.httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except self.httpx.HTTPError as e:
+            raise requests.exceptions.RequestException(str(e)) from e
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = HttpTransport()
+    return _transport
+
+
+class Endpoint:
+    def __init__(self, url, model=None, api_key=None):
+        self.url = url
+        self.model = model or LLM_MODEL
+        self.api_key = api_key if api_key is not None else LLM_API_KEY
+        self.in_flight = 0
+        self.latency = None
+        self.requests = 0
+        self.errors = 0
+        self.healthy = True
+        self.failed_at = None
+        self.last_error = None
+        self.supports_n = None
+
+    @property
+    def models_url(self):
+        if self.url.endswith("/chat/completions"):
+            return self.url[:-len("/chat/completions")] + "/models"
+        return '/'.join(self.url.split('/')[:3])
+
+    def headers(self, stream):
+        headers = {'Content-Type': 'application/json; charset=utf-8', 'Accept': 'text/event-stream' if stream else 'application/json'}
+        if self.api_key:
+            headers['Authorization'] = f'Bearer {self.api_key}'
+        return headers
+
+
+def parse_endpoints(value):
+    value = value.strip()
+    if not value:
+        return []
+    if value.startswith("["):
+        return [Endpoint(entry) if isinstance(entry, str) else Endpoint(entry["url"], entry.get("model"), entry.get("api_key")) for entry in json.loads(value)]
+    return [Endpoint(url.strip()) for url in value.split(",") if url.strip()]
+
+
+def is_replica_failure(e):
+    response = getattr(e, "response", None)
+    return not isinstance(e, requests.exceptions.HTTPError) or response is None or response.status_code >= 500 or response.status_code == 429
+
+
+class EndpointRouter:
+    def __init__(self, endpoints, health_check_interval=HEALTH_CHECK_INTERVAL, cooldown=ENDPOINT_COOLDOWN):
+        self.endpoints = list(endpoints)
+        self.health_check_interval = health_check_interval
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _available(self, endpoint, now):
+        return endpoint.healthy or now - endpoint.failed_at >= self.cooldown
+
+    def _score(self, endpoint, default_latency):
+        latency = endpoint.latency if endpoint.latency is not None else default_latency
+        return ((endpoint.in_flight + 1) * max(latency, 0.001), endpoint.requests)
+
+    def acquire(self, exclude=()):
+        now = time.perf_counter()
+        with self.lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+            if not candidates:
+                return None
+            available = [endpoint for endpoint in candidates if self._available(endpoint, now)] or candidates
+            known_latencies = [endpoint.latency for endpoint in available if endpoint.latency is not None]
+            default_latency = min(known_latencies) if known_latencies else 1.0
+            endpoint = min(available, key=lambda endpoint: self._score(endpoint, default_latency))
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint, sent=None, seconds=None, error=None):
+        with self.lock:
+            endpoint.in_flight -= 1
+            if error is not None:
+                endpoint.errors += 1
+                self._mark_failed(endpoint, error)
+            elif seconds is not None:
+                endpoint.latency = seconds if endpoint.latency is None else 0.8 * endpoint.latency + 0.2 * seconds
+                if endpoint.failed_at is None or sent > endpoint.failed_at:
+                    self._mark_healthy(endpoint)
+
+    def _mark_failed(self, endpoint, error):
+        if endpoint.healthy:
+            logger.warning(f"Endpoint {endpoint.url} marked unhealthy: {error}")
+        endpoint.healthy = False
+        endpoint.failed_at = time.perf_counter()
+        endpoint.last_error = str(error)
+
+    def _mark_healthy(self, endpoint):
+        if not endpoint.healthy:
+            logger.info(f"Endpoint {endpoint.url} is healthy again.")
+        endpoint.healthy = True
+        endpoint.failed_at = None
+        endpoint.last_error = None
+
+    def probe(self, endpoint):
+        try:
+            response = requests.get(endpoint.models_url, headers=endpoint.headers(False), timeout=(CONNECT_TIMEOUT, 5))
+            response.close()
+            if response.status_code >= 500:
+                raise requests.exceptions.HTTPError(f"{response.status_code} from {endpoint.models_url}", response=response)
+        except requests.exceptions.RequestException as e:
+            with self.lock:
+                self._mark_failed(endpoint, e)
+            return False
+        with self.lock:
+            self._mark_healthy(endpoint)
+        return True
+
+    def check_all(self):
+        return [self.probe(endpoint) for endpoint in self.endpoints]
+
+    def start_health_checks(self):
+        if self.health_check_interval <= 0 or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._health_check_loop, name="llm-health-check", daemon=True)
+        self.thread.start()
+
+    def _health_check_loop(self):
+        while not self.stop_event.wait(self.health_check_interval):
+            self.check_all()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stats(self):
+        with self.lock:
+            return [{
+                "url": endpoint.url,
+                "model": endpoint.model,
+                "healthy": endpoint.healthy,
+                "in_flight": endpoint.in_flight,
+                "requests": endpoint.requests,
+                "errors": endpoint.errors,
+                "latency_seconds": endpoint.latency,
+                "last_error": endpoint.last_error,
+            } for endpoint in self.endpoints]
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                endpoints = LLM_ENDPOINTS if isinstance(LLM_ENDPOINTS, list) else parse_endpoints(LLM_ENDPOINTS)
+                _router = EndpointRouter(endpoints or [Endpoint(LOCAL_API_ENDPOINT, LLM_MODEL, LLM_API_KEY)])
+                if len(_router.endpoints) > 1:
+                    logger.info(f"Routing requests across {len(_router.endpoints)} endpoints: {', '.join(endpoint.url for endpoint in _router.endpoints)}.")
+                    _router.start_health_checks()
+    return _router
+
+class ResponseCache:
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL, path=CACHE_PATH, max_disk_mb=CACHE_MAX_DISK_MB, kinds=CACHE_KINDS, max_temperature=CACHE_MAX_TEMPERATURE):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.kinds = set(kinds)
+        self.max_temperature = max_temperature
+        self.max_disk_bytes = int(max_disk_mb * 1024 * 1024)
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = Counter()
+        self.misses = Counter()
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL)")
+            if self.ttl > 0:
+                self.db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+            self.db.commit()
+            self.disk_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def allows(self, kind, temperature):
+        return kind in self.kinds and temperature <= self.max_temperature
+
+    @staticmethod
+    def make_key(payload_dict):
+        canonical = {key: value for key, value in payload_dict.items() if key != "stream"}
+        return hashlib.sha256(json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+    def _expired(self, created):
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def get(self, key, kind):
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and self._expired(entry[1]):
+                del self.memory[key]
+                entry = None
+            if entry is not None:
+                self.memory.move_to_end(key)
+            elif self.db is not None:
+                row = self.db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and not self._expired(row[1]):
+                    self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+                    self.db.commit()
+                    entry = (row[0], row[1])
+                    self._remember(key, entry)
+            if entry is None:
+                self.misses[kind] += 1
+                return None
+            self.hits[kind] += 1
+            return entry[0]
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self._remember(key, (value, now))
+            if self.db is not None:
+                size = len(value.encode("utf-8"))
+                previous = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+                self.db.execute("INSERT OR REPLACE INTO responses (key, value, created, accessed, size) VALUES (?, ?, ?, ?, ?)", (key, value, now, now, size))
+                self.disk_bytes += size - (previous[0] if previous else 0)
+                while self.disk_bytes > self.max_disk_bytes:
+                    row = self.db.execute("SELECT key, size FROM responses ORDER BY accessed LIMIT 1").fetchone()
+                    if row is None:
+                        break
+                    self.db.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+                    self.disk_bytes -= row[1]
+                self.db.commit()
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            hits, misses = sum(self.hits.values()), sum(self.misses.values())
+            return {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+                "by_kind": {kind: {"hits": self.hits[kind], "misses": self.misses[kind]} for kind in sorted(set(self.hits) | set(self.misses))},
+                "memory_entries": len(self.memory),
+                "disk_bytes": self.disk_bytes if self.db is not None else 0,
+            }
+
+
+response_cache = ResponseCache() if CACHE_ENABLED else None
+
+
+class CheckpointStore:
+    def __init__(self, path=CHECKPOINT_PATH, max_turns=CHECKPOINT_MAX_TURNS):
+        self.max_turns = max_turns
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS turns (turn TEXT PRIMARY KEY, accessed REAL NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS nodes (turn TEXT NOT NULL, node TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (turn, node))")
+            self.db.commit()
+
+    @staticmethod
+    def make_turn_key(compute_level, user_input, history, temperature, top_p, top_k):
+        turn = {"level": compute_level, "input": user_input, "history": [list(pair) for pair in history or []], "temperature": temperature, "top_p": top_p, "top_k": top_k, "model": LLM_MODEL}
+        return hashlib.sha256(json.dumps(turn, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def load(self, turn_key):
+        with self.lock:
+            nodes = self.memory.get(turn_key)
+            if nodes is None:
+                nodes = {}
+                if self.db is not None:
+                    nodes = dict(self.db.execute("SELECT node, value FROM nodes WHERE turn = ?", (turn_key,)).fetchall())
+                self.memory[turn_key] = nodes
+            self.memory.move_to_end(turn_key)
+            while len(self.memory) > self.max_turns:
+                self.memory.popitem(last=False)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO turns (turn, accessed) VALUES (?, ?)", (turn_key, time.time()))
+                self._prune()
+                self.db.commit()
+            return dict(nodes)
+
+    def save(self, turn_key, node_key, value):
+        with self.lock:
+            self.memory.setdefault(turn_key, {})[node_key] = value
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO nodes (turn, node, value) VALUES (?, ?, ?)", (turn_key, node_key, value))
+                self.db.execute("INSERT OR IGNORE INTO turns (turn, accessed) VALUES (?, ?)", (turn_key, time.time()))
+                self.db.commit()
+
+    def discard(self, turn_key):
+        with self.lock:
+            self.memory.pop(turn_key, None)
+            if self.db is not None:
+                self.db.execute("DELETE FROM nodes WHERE turn = ?", (turn_key,))
+                self.db.execute("DELETE FROM turns WHERE turn = ?", (turn_key,))
+                self.db.commit()
+
+    def _prune(self):
+        stale = [row[0] for row in self.db.execute("SELECT turn FROM turns ORDER BY accessed DESC LIMIT -1 OFFSET ?", (self.max_turns,)).fetchall()]
+        for turn_key in stale:
+            self.db.execute("DELETE FROM nodes WHERE turn = ?", (turn_key,))
+            self.db.execute("DELETE FROM turns WHERE turn = ?", (turn_key,))
+
+
+class TurnCheckpoint:
+    def __init__(self, store, turn_key):
+        self.store = store
+        self.turn_key = turn_key
+        self.nodes = store.load(turn_key) if store is not None else {}
+        self.restored = False
+
+    @staticmethod
+    def node_key(node_id, fingerprint="", deps=None):
+        content = json.dumps([fingerprint, sorted(deps.items()) if deps else []], ensure_ascii=False)
+        return "/".join(map(str, node_id)) + ":" + hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+    def wrap(self, node_id, fn, fingerprint="", replay=None):
+        def run(*args):
+            deps = args[0] if args and isinstance(args[0], dict) else None
+            node_key = self.node_key(node_id, fingerprint, deps)
+            value = self.nodes.get(node_key)
+            if value is not None:
+                logger.debug(f"Node {node_id} restored from checkpoint {self.turn_key[:12]}.")
+                self.restored = True
+                if replay is not None:
+                    replay(value, *args)
+                return value
+            value = fn(*args)
+            if self.store is not None and isinstance(value, str) and not is_llm_error(value):
+                self.nodes[node_key] = value
+                self.store.save(self.turn_key, node_key, value)
+            return value
+        return run
+
+    def complete(self):
+        if self.store is not None and not CHECKPOINT_KEEP_COMPLETED:
+            self.store.discard(self.turn_key)
+
+
+checkpoint_store = CheckpointStore() if CHECKPOINTS_ENABLED else None
+
+
+def open_checkpoint(compute_level, user_input, history, temperature, top_p, top_k):
+    if checkpoint_store is None:
+        return TurnCheckpoint(None, None)
+    return TurnCheckpoint(checkpoint_store, CheckpointStore.make_turn_key(compute_level, user_input, history, temperature, top_p, top_k))
+
+
+class SSEParser:
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.buffer = ""
+        self.data_lines = []
+
+    def feed(self, chunk_bytes):
+        text = self.decoder.decode(chunk_bytes)
+        if "\n" not in text:
+            self.buffer += text
+            return []
+        text = self.buffer + text
+        if "\r" in text:
+            text = text.replace("\r\n", "\n")
+        lines = text.split("\n")
+        self.buffer = lines.pop()
+        return self._process(lines)
+
+    def flush(self):
+        lines = [(self.buffer + self.decoder.decode(b"", final=True)).rstrip("\r"), ""]
+        self.buffer = ""
+        return self._process(lines)
+
+    def _process(self, lines):
+        events = []
+        data_lines = self.data_lines
+        for line in lines:
+            if line.startswith("data:"):
+                data_lines.append(line[6:] if line[5:6] == " " else line[5:])
+            elif not line or line == "\r":
+                if data_lines:
+                    events.append(data_lines[0] if len(data_lines) == 1 else "\n".join(data_lines))
+                    data_lines = []
+        self.data_lines = data_lines
+        return events
+
+
+def iter_sse_events(byte_chunks):
+    parser = SSEParser()
+    for chunk_bytes in byte_chunks:
+        if chunk_bytes:
+            yield from parser.feed(chunk_bytes)
+    yield from parser.flush()
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4) if text else 0
+
+
+class LlmCallSpan:
+    def __init__(self, role, kind, stream):
+        self.role = role
+        self.kind = kind
+        self.stream = stream
+        self.trace = current_trace.get()
+        self.budget = current_budget.get()
+        if self.budget is not None:
+            self.budget.start_call()
+        self.thread = threading.current_thread().name
+        self.started = time.perf_counter()
+        self.ended = None
+        self.first_token = None
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.estimated_tokens = False
+        self.cached = False
+        self.error = False
+        self.endpoint = None
+        self.hedged = False
+        self.queue_seconds = 0.0
+
+    def mark_first_token(self):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+
+    def set_usage(self, usage):
+        if usage:
+            self.prompt_tokens = usage.get("prompt_tokens", self.prompt_tokens)
+            self.completion_tokens = usage.get("completion_tokens", self.completion_tokens)
+
+    def finish(self, prompt_text="", completion_chunks=(), error=False):
+        self.ended = time.perf_counter()
+        self.error = error
+        if self.prompt_tokens is None:
+            self.prompt_tokens = estimate_tokens(prompt_text)
+            self.estimated_tokens = True
+        if self.completion_tokens is None:
+            self.completion_tokens = len(completion_chunks) if self.stream else estimate_tokens("".join(completion_chunks))
+            self.estimated_tokens = True
+        if self.trace is not None:
+            self.trace.add_span(self)
+        if self.budget is not None:
+            self.budget.finish_call(self.kind, None if self.cached else self.prompt_tokens, None if self.cached else self.completion_tokens, self.ended - self.started)
+        ttft = f"{(self.first_token - self.started) * 1000:.0f}ms" if self.first_token is not None else "-"
+        logger.debug(f"LLM call '{self.role}' ({self.kind}) finished in {(self.ended - self.started) * 1000:.0f}ms, TTFT {ttft}, tokens {self.prompt_tokens}+{self.completion_tokens}{' (estimated)' if self.estimated_tokens else ''}{', cached' if self.cached else ''}{', hedged' if self.hedged else ''}{', error' if error else ''}.")
+
+
+class RequestTrace:
+    def __init__(self, compute_level, user_input=""):
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.compute_level = compute_level
+        self.user_input = user_input
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.ended = None
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add_span(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def finish(self):
+        if self.ended is None:
+            self.ended = time.perf_counter()
+
+    def summary(self):
+        with self.lock:
+            spans = list(self.spans)
+        by_kind = {}
+        for span in spans:
+            stats = by_kind.setdefault(span.kind, {"calls": 0, "cached_calls": 0, "errors": 0, "seconds": 0.0, "ttft_seconds": 0.0, "queue_seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0})
+            stats["calls"] += 1
+            stats["queue_seconds"] += span.queue_seconds
+            stats["cached_calls"] += span.cached
+            stats["errors"] += span.error
+            stats["seconds"] += span.ended - span.started
+            stats["ttft_seconds"] += (span.first_token or span.ended) - span.started
+            stats["prompt_tokens"] += span.prompt_tokens
+            stats["completion_tokens"] += span.completion_tokens
+        for stats in by_kind.values():
+            stats["avg_seconds"] = stats["seconds"] / stats["calls"]
+            stats["avg_ttft_seconds"] = stats.pop("ttft_seconds") / stats["calls"]
+        return {
+            "trace_id": self.trace_id,
+            "compute_level": self.compute_level,
+            "wall_seconds": (self.ended or time.perf_counter()) - self.started,
+            "llm_calls": len(spans),
+            "prompt_tokens": sum(span.prompt_tokens for span in spans),
+            "completion_tokens": sum(span.completion_tokens for span in spans),
+            "llm_seconds": sum(span.ended - span.started for span in spans),
+            "queue_seconds": sum(span.queue_seconds for span in spans),
+            "max_concurrency": self._max_concurrency(spans),
+            "by_kind": by_kind,
+        }
+
+    @staticmethod
+    def _max_concurrency(spans):
+        edges = sorted([(span.started, 1) for span in spans] + [(span.ended, -1) for span in spans])
+        current = peak = 0
+        for _, change in edges:
+            current += change
+            peak = max(peak, current)
+        return peak
+
+    def to_chrome_trace(self):
+        with self.lock:
+            spans = list(self.spans)
+        thread_ids = {}
+        events = []
+        for span in spans:
+            tid = thread_ids.setdefault(span.thread, len(thread_ids) + 1)
+            events.append({
+                "name": span.role,
+                "cat": span.kind,
+                "ph": "X",
+                "pid": 1,
+                "tid": tid,
+                "ts": (span.started - self.started) * 1e6,
+                "dur": (span.ended - span.started) * 1e6,
+                "args": {
+                    "ttft_ms": (span.first_token - span.started) * 1000 if span.first_token is not None else None,
+                    "prompt_tokens": span.prompt_tokens,
+                    "completion_tokens": span.completion_tokens,
+                    "estimated_tokens": span.estimated_tokens,
+                    "stream": span.stream,
+                    "cached": span.cached,
+                    "error": span.error,
+                    "endpoint": span.endpoint,
+                    "hedged": span.hedged,
+                    "queue_ms": span.queue_seconds * 1000,
+                },
+            })
+        events.append({"name": "process_name", "ph": "M", "pid": 1, "args": {"name": f"{self.compute_level} request {self.trace_id}"}})
+        for thread, tid in thread_ids.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": thread}})
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": self.summary()}
+
+    def save(self, directory=TRACE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))}-{self.compute_level}-{self.trace_id}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_chrome_trace(), f, ensure_ascii=False)
+        return path
+
+
+class LevelMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.levels = {}
+
+    def record(self, summary):
+        with self.lock:
+            totals = self.levels.setdefault(summary["compute_level"], Counter())
+            totals["requests"] += 1
+            for key in ("wall_seconds", "llm_calls", "prompt_tokens", "completion_tokens", "llm_seconds"):
+                totals[key] += summary[key]
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {}
+            for level, totals in self.levels.items():
+                requests_count = totals["requests"]
+                snapshot[level] = dict(totals)
+                snapshot[level].update({
+                    "avg_wall_seconds": totals["wall_seconds"] / requests_count,
+                    "avg_llm_calls": totals["llm_calls"] / requests_count,
+                    "avg_completion_tokens": totals["completion_tokens"] / requests_count,
+                })
+            return snapshot
+
+
+class Budget:
+    def __init__(self, tokens=0, seconds=0.0):
+        self.tokens = max(0, int(tokens or 0))
+        self.seconds = max(0.0, float(seconds or 0))
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.used_tokens = 0
+        self.sampled_tokens = 0
+        self.sampled_completion_tokens = 0
+        self.calls = 0
+        self.sampled_calls = 0
+        self.call_seconds = 0.0
+        self.in_flight = 0
+        self.stopped_early = False
+        self.adjustments = []
+
+    @property
+    def limited(self):
+        return bool(self.tokens or self.seconds)
+
+    def start_call(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def finish_call(self, kind, prompt_tokens, completion_tokens, seconds):
+        with self.lock:
+            self.in_flight -= 1
+            if prompt_tokens is not None:
+                self.calls += 1
+                self.used_tokens += prompt_tokens + completion_tokens
+                if kind != "decompose":
+                    self.sampled_tokens += prompt_tokens + completion_tokens
+                    self.sampled_completion_tokens += completion_tokens
+                    self.sampled_calls += 1
+                    self.call_seconds += seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def note(self, adjustment):
+        with self.lock:
+            self.adjustments.append(adjustment)
+        logger.info(f"[Budget] {adjustment}")
+
+    def affordable_calls(self, reserve_calls=1, fallback_tokens=ANSWER_TOKENS_ESTIMATE):
+        if not self.limited:
+            return None
+        with self.lock:
+            affordable = []
+            if self.tokens:
+                tokens_per_call = self.sampled_tokens / self.sampled_calls if self.sampled_calls else fallback_tokens
+                completion_per_call = self.sampled_completion_tokens / self.sampled_calls if self.sampled_calls else ANSWER_TOKENS_ESTIMATE
+                cost_per_call = tokens_per_call + completion_per_call
+                available = self.tokens - self.used_tokens - self.sampled_completion_tokens - reserve_calls * tokens_per_call - self.in_flight * cost_per_call
+                affordable.append(int(available / max(cost_per_call, 1)))
+            if self.seconds and self.sampled_calls:
+                seconds_per_call = self.call_seconds / self.sampled_calls
+                waves = int((self.seconds - self.elapsed()) / max(seconds_per_call, 0.001)) - reserve_calls
+                affordable.append(waves * MAX_PARALLEL_REQUESTS - self.in_flight)
+            return max(0, min(affordable)) if affordable else None
+
+    def can_afford(self, calls=1, reserve_calls=1, fallback_tokens=ANSWER_TOKENS_ESTIMATE):
+        affordable = self.affordable_calls(reserve_calls, fallback_tokens)
+        return affordable is None or affordable >= calls
+
+    def out_of_time(self, reserve_calls=1):
+        if not self.seconds:
+            return False
+        with self.lock:
+            seconds_per_call = self.call_seconds / self.sampled_calls if self.sampled_calls else 0.0
+        return self.elapsed() + seconds_per_call * reserve_calls >= self.seconds
+
+    def remaining_tokens(self):
+        return self.tokens - self.used_tokens if self.tokens else None
+
+    def max_tokens_for(self, prompt_tokens):
+        if not self.tokens:
+            return None
+        return max(64, self.remaining_tokens() - prompt_tokens)
+
+    def report(self):
+        with self.lock:
+            return {
+                "token_budget": self.tokens or None,
+                "tokens_used": self.used_tokens,
+                "time_budget_seconds": self.seconds or None,
+                "seconds_used": self.elapsed(),
+                "llm_calls": self.calls,
+                "stopped_early": self.stopped_early,
+                "adjustments": list(self.adjustments),
+            }
+
+    def describe(self):
+        parts = []
+        if self.tokens:
+            parts.append(f"{self.used_tokens:,}/{self.tokens:,} tokens")
+        if self.seconds:
+            parts.append(f"{self.elapsed():.1f}/{self.seconds:g}s")
+        if self.stopped_early:
+            parts.append("stopped early with a partial synthesis")
+        return "Budget used: " + ", ".join(parts) + "."
+
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+current_budget = contextvars.ContextVar("current_budget", default=None)
+current_synthesis_batch = contextvars.ContextVar("current_synthesis_batch", default=None)
+current_sample_slots = contextvars.ContextVar("current_sample_slots", default=None)
+level_metrics = LevelMetrics()
+
+
+def get_budget():
+    return current_budget.get() or Budget()
+
+
+def get_synthesis_batch_tokens():
+    batch_tokens = current_synthesis_batch.get()
+    return SYNTHESIS_BATCH_TOKENS if batch_tokens is None else batch_tokens
+
+
+def trace_compute(compute_function, trace, user_input, history, temperature, top_p, top_k, budget=None, synthesis_batch_tokens=None):
+    context = contextvars.copy_context()
+    context.run(current_trace.set, trace)
+    context.run(current_budget.set, budget)
+    context.run(current_synthesis_batch.set, synthesis_batch_tokens)
+    context.run(current_sample_slots.set, threading.BoundedSemaphore(MAX_PARALLEL_REQUESTS))
+    response_generator = context.run(compute_function, user_input, history, temperature, top_p, top_k)
+    try:
+        while True:
+            try:
+                response_part = context.run(next, response_generator)
+            except StopIteration:
+                break
+            yield response_part
+    finally:
+        context.run(response_generator.close)
+        trace.finish()
+        summary = trace.summary()
+        level_metrics.record(summary)
+        queued = f", {summary['queue_seconds']:.1f}s queued in the scheduler" if summary["queue_seconds"] >= 0.05 else ""
+        logger.info(f"[Trace {trace.trace_id}] {trace.compute_level}: {summary['wall_seconds']:.1f}s wall, {summary['llm_calls']} LLM calls, {summary['prompt_tokens']}+{summary['completion_tokens']} tokens, peak concurrency {summary['max_concurrency']}{queued}.")
+        if budget is not None and budget.limited:
+            logger.info(f"[Trace {trace.trace_id}] {budget.describe()}")
+        if TRACE_DIR:
+            logger.info(f"[Trace {trace.trace_id}] Chrome trace written to {trace.save()}.")
+
+
+class LatencyTracker:
+    def __init__(self, window=HEDGE_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, kind, seconds):
+        with self.lock:
+            self.samples.setdefault(kind, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, kind, percentile, min_samples=None):
+        with self.lock:
+            samples = sorted(self.samples.get(kind, ()))
+        if len(samples) < max(1, HEDGE_MIN_SAMPLES if min_samples is None else min_samples):
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+    def hedge_delay(self, kind):
+        if HEDGE_PERCENTILE <= 0:
+            return None
+        return self.percentile(kind, HEDGE_PERCENTILE)
+
+
+latency_tracker = LatencyTracker()
+
+
+PRIORITY_CLASSES = ("interactive", "normal", "background")
+KIND_PRIORITIES = {"direct": 0, "summary": 0, "decompose": 1, "synthesis": 1, "judge": 1, "solve": 2}
+
+
+def request_priority(kind, role=None):
+    return 0 if role == "final synthesis" else KIND_PRIORITIES.get(kind, 1)
+
+
+class RequestScheduler:
+    def __init__(self, max_in_flight=SCHEDULER_MAX_IN_FLIGHT, interactive_reserve=SCHEDULER_INTERACTIVE_RESERVE, window=SCHEDULER_WINDOW):
+        self.max_in_flight = max(0, max_in_flight)
+        self.interactive_reserve = max(0, interactive_reserve)
+        self.lock = threading.Lock()
+        self.queues = [OrderedDict() for _ in PRIORITY_CLASSES]
+        self.queued = [0] * len(PRIORITY_CLASSES)
+        self.peak_queued = [0] * len(PRIORITY_CLASSES)
+        self.granted = [0] * len(PRIORITY_CLASSES)
+        self.waits = [deque(maxlen=window) for _ in PRIORITY_CLASSES]
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def limit(self, priority):
+        if not self.max_in_flight:
+            return None
+        if priority == 0:
+            return self.max_in_flight
+        return max(1, self.max_in_flight - self.interactive_reserve)
+
+    def _fits(self, priority):
+        limit = self.limit(priority)
+        return limit is None or self.in_flight < limit
+
+    def _grant(self, priority):
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        self.granted[priority] += 1
+
+    def _dispatch(self):
+        for priority, sessions in enumerate(self.queues):
+            while sessions and self._fits(priority):
+                session, waiters = next(iter(sessions.items()))
+                waiter = waiters.popleft()
+                if waiters:
+                    sessions.move_to_end(session)
+                else:
+                    del sessions[session]
+                self.queued[priority] -= 1
+                self._grant(priority)
+                waiter.set()
+
+    def acquire(self, priority, session=None):
+        started = time.perf_counter()
+        with self.lock:
+            if not any(self.queued[:priority + 1]) and self._fits(priority):
+                self._grant(priority)
+                self.waits[priority].append(0.0)
+                return 0.0
+            waiter = threading.Event()
+            self.queues[priority].setdefault(session, deque()).append(waiter)
+            self.queued[priority] += 1
+            self.peak_queued[priority] = max(self.peak_queued[priority], self.queued[priority])
+        waiter.wait()
+        waited = time.perf_counter() - started
+        with self.lock:
+            self.waits[priority].append(waited)
+        if waited >= 1.0:
+            logger.debug(f"[Scheduler] {PRIORITY_CLASSES[priority].capitalize()} request waited {waited:.2f}s for a slot.")
+        return waited
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+            self._dispatch()
+
+    def stats(self):
+        with self.lock:
+            classes = {}
+            for priority, name in enumerate(PRIORITY_CLASSES):
+                waits = sorted(self.waits[priority])
+                classes[name] = {
+                    "queued": self.queued[priority],
+                    "peak_queued": self.peak_queued[priority],
+                    "granted": self.granted[priority],
+                    "avg_wait_seconds": sum(waits) / len(waits) if waits else 0.0,
+                    "p95_wait_seconds": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0,
+                    "max_wait_seconds": waits[-1] if waits else 0.0,
+                }
+            return {"max_in_flight": self.max_in_flight or None, "in_flight": self.in_flight, "peak_in_flight": self.peak_in_flight, "classes": classes}
+
+
+request_scheduler = RequestScheduler()
+
+
+def retry_delay(retry_round, error):
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return min(max(0.0, float(retry_after)), RETRY_MAX_BACKOFF)
+        except ValueError:
+            pass
+    ceiling = min(RETRY_MAX_BACKOFF, RETRY_BACKOFF * 2 ** retry_round)
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+def backoff_before_retry(retry_round, error, role):
+    if retry_round >= RETRY_ATTEMPTS:
+        return False
+    delay = retry_delay(retry_round, error)
+    budget = current_budget.get()
+    if budget is not None and budget.seconds and budget.elapsed() + delay >= budget.seconds:
+        logger.warning(f"Request '{role}' failed ({error}). Not retrying: the time budget would run out.")
+        return False
+    logger.warning(f"Request '{role}' failed ({error}). Retrying in {delay:.2f}s (retry {retry_round + 1}/{RETRY_ATTEMPTS})...")
+    time.sleep(delay)
+    return True
+
+
+def post_request(endpoint, payload, stream):
+    response = get_transport().post(endpoint.url, headers=endpoint.headers(stream), data=payload.encode('utf-8'), stream=stream)
+    if stream:
+        try:
+            response.raise_for_status()
+        except BaseException:
+            response.close()
+            raise
+        return response
+    try:
+        response.raise_for_status()
+        response.encoding = response.apparent_encoding if response.encoding is None else response.encoding
+        return response.json()
+    finally:
+        response.close()
+
+
+def send_request(router, payload_dict, stream, role):
+    tried = []
+    retry_round = 0
+    while True:
+        endpoint = router.acquire(exclude=tried)
+        tried.append(endpoint)
+        request_payload = dict(payload_dict, model=endpoint.model)
+        if endpoint.supports_n is False:
+            request_payload.pop("n", None)
+        payload = json.dumps(request_payload)
+        logger.debug(f"Sending request to {endpoint.url} {'using' if endpoint.api_key else 'without'} API Key. Model: '{endpoint.model}', Stream: {stream}, Payload: {payload[:200]}...")
+        sent = time.perf_counter()
+        try:
+            return endpoint, post_request(endpoint, payload, stream), sent
+        except requests.exceptions.RequestException as e:
+            if not is_replica_failure(e):
+                router.release(endpoint)
+                if "n" in request_payload and isinstance(e, requests.exceptions.HTTPError):
+                    logger.info(f"{endpoint.url} rejected n={request_payload['n']} ({e}); sending samples to it as separate requests from now on.")
+                    endpoint.supports_n = False
+                    tried.pop()
+                    continue
+                raise
+            router.release(endpoint, error=e)
+            if len(tried) < len(router.endpoints):
+                logger.warning(f"Request '{role}' to {endpoint.url} failed ({e}). Failing over to another endpoint...")
+                continue
+            if not backoff_before_retry(retry_round, e, role):
+                raise
+            retry_round += 1
+            tried = []
+
+
+def send_hedged(router, payload_dict, kind, role, priority=1, session=None):
+    delay = latency_tracker.hedge_delay(kind)
+    if delay is None:
+        return send_request(router, payload_dict, False, role) + (False,)
+    results = queue.Queue()
+    lock = threading.Lock()
+    winners = []
+    running = 1
+    hedge_slot = False
+
+    def attempt():
+        nonlocal running
+        try:
+            result = send_request(router, payload_dict, False, role)
+        except Exception as e:
+            results.put((None, e))
+            return
+        finally:
+            with lock:
+                running -= 1
+                release = hedge_slot and running == 0
+            if release:
+                request_scheduler.release()
+        with lock:
+            won = not winners
+            winners.append(result)
+        if won:
+            results.put((result, None))
+        else:
+            endpoint, _, sent = result
+            router.release(endpoint, sent, seconds=time.perf_counter() - sent)
+
+    def hedge():
+        nonlocal running, hedge_slot
+        request_scheduler.acquire(priority, session)
+        with lock:
+            skip = bool(winners)
+            if not skip:
+                running += 1
+                hedge_slot = True
+        if skip:
+            request_scheduler.release()
+        else:
+            attempt()
 
-def call_llm(prompt, chat_history_gradio=None, temperature=0.7, top_p=None, top_k=None, stream=False):
+    def start(name, target):
+        threading.Thread(target=contextvars.copy_context().run, args=(target,), name=name, daemon=True).start()
+
+    start("llm-request", attempt)
+    try:
+        result, error = results.get(timeout=delay)
+        hedged = False
+    except queue.Empty:
+        logger.info(f"Request '{role}' is slower than p{HEDGE_PERCENTILE:g} of recent '{kind}' calls ({delay:.2f}s). Sending a hedged duplicate...")
+        start("llm-hedge", hedge)
+        hedged = True
+        result, error = results.get()
+        if error is not None:
+            result, error = results.get()
+    if error is not None:
+        raise error
+    return result + (hedged,)
+
+
+def call_llm(prompt, chat_history_gradio=None, temperature=0.7, top_p=None, top_k=None, stream=False, kind="direct", role=None, max_tokens=None, n=None, use_cache=True):
     messages = []
     if chat_history_gradio:
         for user_msg, assistant_msg in chat_history_gradio:
@@ -36,339 +1172,1227 @@ def call_llm(prompt, chat_history_gradio=None, temperature=0.7, top_p=None, top_
          payload_dict["top_p"] = top_p
     if top_k is not None and top_k > 0:
          payload_dict["top_k"] = top_k
-
-    payload = json.dumps(payload_dict)
-    headers = {'Content-Type': 'application/json; charset=utf-8', 'Accept': 'text/event-stream' if stream else 'application/json'}
-
-    if LLM_API_KEY:
-        headers['Authorization'] = f'Bearer {LLM_API_KEY}'
-        print(f"Sending request to {LOCAL_API_ENDPOINT} using API Key.")
-    else:
-        print(f"Sending request to {LOCAL_API_ENDPOINT} without API Key.")
-
-    print(f"Model: '{LLM_MODEL}', Stream: {stream}, Payload: {payload[:200]}...")
-
+    if max_tokens is not None:
+        payload_dict["max_tokens"] = max_tokens
+    if n is not None and n > 1:
+        payload_dict["n"] = n
+    if PREFIX_CACHE_HINT == "llama.cpp":
+        payload_dict["cache_prompt"] = True
+    elif PREFIX_CACHE_HINT == "openai":
+        payload_dict["prompt_cache_key"] = prefix_cache_key(messages)
+
+    span = LlmCallSpan(role or kind, kind, stream)
+    prompt_text = "".join(message["content"] for message in messages)
+    cache_key = None
+    if use_cache and n is None and response_cache is not None and response_cache.allows(kind, temperature):
+        cache_key = response_cache.make_key(payload_dict)
+        cached_content = response_cache.get(cache_key, kind)
+        if cached_content is not None:
+            logger.debug(f"Cache hit for '{kind}' request ({cache_key[:12]}).")
+            span.cached = True
+            span.mark_first_token()
+            span.finish(prompt_text, [cached_content])
+            yield cached_content
+            return
+
+    trace = current_trace.get()
+    priority = request_priority(kind, role)
+    session = trace.trace_id if trace is not None else None
+    span.queue_seconds = request_scheduler.acquire(priority, session)
+    router = get_router()
+    endpoint = None
+    sent = None
+    replica_error = None
+    response = None
+    completion_chunks = []
+    failed = True
+    stream_failed = False
     try:
-        response = requests.post(LOCAL_API_ENDPOINT, headers=headers, data=payload.encode('utf-8'), timeout=36000, stream=stream)
-        response.raise_for_status()
-
         if stream:
-            print("Processing stream...")
-            for chunk_bytes in response.iter_content(chunk_size=None):
-                 if not chunk_bytes:
-                     continue
-                 try:
-                     lines = chunk_bytes.decode('utf-8').splitlines()
-                     for line in lines:
-                         if line.startswith("data:"):
-                             line_data = line[len("data:"):].strip()
-                             if line_data == "[DONE]":
-                                 print("Stream finished.")
-                                 break
-                             try:
-                                 chunk = json.loads(line_data)
-                                 if chunk.get("choices") and len(chunk["choices"]) > 0:
-                                     delta = chunk["choices"][0].get("delta", {})
-                                     content_chunk = delta.get("content")
-                                     if content_chunk:
-                                         yield content_chunk
-                             except json.JSONDecodeError:
-                                 print(f"Warning: Could not decode stream line JSON: {line_data}")
-                                 continue
-                             except Exception as e:
-                                 print(f"Error processing stream chunk: {e}, Line: {line_data}")
-                                 yield f"\n[Error processing stream chunk: {e}]"
-                                 break
-                     else:
-                         continue
-                     break
-                 except UnicodeDecodeError:
-                     print(f"Warning: Could not decode chunk as UTF-8: {chunk_bytes[:100]}...")
-                     continue
-            print("Stream processing complete.")
+            retry_round = 0
+            while True:
+                endpoint, response, sent = send_request(router, payload_dict, True, role or kind)
+                span.endpoint = endpoint.url
+                logger.debug("Processing stream...")
+                stream_failed = False
+                try:
+                    for line_data in iter_sse_events(response.iter_content(chunk_size=None)):
+                        if line_data == "[DONE]":
+                            logger.debug("Stream finished.")
+                            break
+                        try:
+                            chunk = json.loads(line_data)
+                            if chunk.get("usage"):
+                                span.set_usage(chunk["usage"])
+                            if chunk.get("choices") and len(chunk["choices"]) > 0:
+                                delta = chunk["choices"][0].get("delta", {})
+                                content_chunk = delta.get("content")
+                                if content_chunk:
+                                    span.mark_first_token()
+                                    completion_chunks.append(content_chunk)
+                                    yield content_chunk
+                        except json.JSONDecodeError:
+                            logger.warning(f"Could not decode stream event JSON: {line_data}")
+                            continue
+                        except Exception as e:
+                            logger.error(f"Error processing stream chunk: {e}, Line: {line_data}")
+                            stream_failed = True
+                            yield f"\n[Error processing stream chunk: {e}]"
+                            break
+                    break
+                except requests.exceptions.RequestException as e:
+                    if completion_chunks or not is_replica_failure(e) or not backoff_before_retry(retry_round, e, role or kind):
+                        raise
+                    retry_round += 1
+                    response.close()
+                    response = None
+                    router.release(endpoint, error=e)
+                    endpoint = None
+            logger.debug("Stream processing complete.")
+            failed = stream_failed
+            if cache_key is not None and not stream_failed and completion_chunks:
+                response_cache.put(cache_key, "".join(completion_chunks))
 
         else:
-            response.encoding = response.apparent_encoding if response.encoding is None else response.encoding
-            data = response.json()
-            print(f"Received non-stream response: {json.dumps(data, ensure_ascii=False, indent=2)}")
-
+            endpoint, data, sent, span.hedged = send_hedged(router, payload_dict, kind, role or kind, priority, session)
+            span.endpoint = endpoint.url
+            span.mark_first_token()
+            span.set_usage(data.get("usage"))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Received non-stream response: {json.dumps(data, ensure_ascii=False)[:2000]}")
+
+            if n is not None and n > 1 and data.get("choices"):
+                if len(data["choices"]) < n and endpoint.supports_n is not False:
+                    logger.info(f"{endpoint.url} returned {len(data['choices'])} of {n} requested choices; sending samples to it as separate requests from now on.")
+                endpoint.supports_n = len(data["choices"]) >= n
             if data.get("choices") and len(data["choices"]) > 0:
-                message_content = data["choices"][0].get("message", {}).get("content")
-                if message_content:
-                    yield message_content.strip()
+                message_contents = [choice.get("message", {}).get("content") for choice in data["choices"][:n or 1]]
+                message_contents = [message_content.strip() for message_content in message_contents if message_content]
+                if message_contents:
+                    completion_chunks.extend(message_contents)
+                    failed = False
+                    latency_tracker.record(kind, time.perf_counter() - sent)
+                    if cache_key is not None:
+                        response_cache.put(cache_key, message_contents[0])
+                    yield from message_contents
                 else:
-                    print("Error: 'content' key not found in LLM response choice.")
+                    logger.error("Error: 'content' key not found in LLM response choice.")
                     yield "Error: 'content' not found in LLM response."
             else:
-                print("Error: 'choices' array is missing, empty, or invalid in LLM response.")
+                logger.error("Error: 'choices' array is missing, empty, or invalid in LLM response.")
                 yield "Error: Invalid format in LLM response (missing 'choices')."
 
-    except requests.exceptions.Timeout:
-        print(f"Network error: Request timed out after 36000 seconds.")
+    except GeneratorExit:
+        failed = stream_failed or not completion_chunks
+        raise
+    except requests.exceptions.Timeout as e:
+        replica_error = e
+        logger.error(f"Network error: Request '{role or kind}' timed out (connect timeout {CONNECT_TIMEOUT}s, read timeout {READ_TIMEOUT}s): {e}")
         yield "Network error: Request timed out."
     except requests.exceptions.RequestException as e:
-        print(f"Network error: {e}")
+        replica_error = e if is_replica_failure(e) else None
+        logger.error(f"Network error: {e}")
         yield f"Network error: {e}"
     except json.JSONDecodeError as e:
-        print(f"Error: Failed to decode JSON response from server. Response text: {response.text}")
+        logger.error(f"Error: Failed to decode JSON response from server. Response text: {e.doc[:2000]}")
         yield f"Error: Failed to read server response (JSONDecodeError: {e}). Check server logs."
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        logger.error(f"An unexpected error occurred: {e}")
         yield f"An unexpected error occurred: {e}"
+    finally:
+        if response is not None:
+            response.close()
+        if endpoint is not None:
+            router.release(endpoint, sent, seconds=None if failed else (span.first_token or time.perf_counter()) - sent, error=replica_error)
+        request_scheduler.release()
+        span.finish(prompt_text, completion_chunks, error=failed)
+
+
+async def acall_llm(prompt, chat_history_gradio=None, temperature=0.7, top_p=None, top_k=None, stream=False, kind="direct", role=None, max_tokens=None):
+    chunks = call_llm(prompt, chat_history_gradio=chat_history_gradio, temperature=temperature, top_p=top_p, top_k=top_k, stream=stream, kind=kind, role=role, max_tokens=max_tokens)
+    finished = object()
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, finished)
+            if chunk is finished:
+                break
+            yield chunk
+    finally:
+        try:
+            chunks.close()
+        except ValueError:
+            pass
+
+
+def run_in_parallel(tasks, max_workers=None):
+    max_workers = max(1, min(max_workers or MAX_PARALLEL_REQUESTS, len(tasks) or 1))
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-worker")
+    futures = {executor.submit(contextvars.copy_context().run, task): index for index, task in enumerate(tasks)}
+    try:
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
 
 
-def low_compute(user_input, history, temperature, top_p, top_k):
-    yield "[Status] Sending request directly to LLM..."
-    print("[Low Mode] Sending LLM request (streaming)...")
-    full_response = ""
-    for chunk in call_llm(user_input, chat_history_gradio=history, temperature=temperature, top_p=top_p, top_k=top_k, stream=True):
-        full_response += chunk
-        yield full_response
-    print("[Low Mode] Response stream finished.")
-
-
-def medium_compute(user_input, history, temperature, top_p, top_k):
-    yield "[Status] Starting task decomposition (1 level)..."
-    print("[Medium Mode] Starting task decomposition...")
-    control_temp = max(0.1, temperature * 0.5)
-    decompose_prompt = f'Original task: "{user_input}". Break it down into logical subtasks needed to solve it (numbered list). Be concise.'
-
-    subtasks_text_gen = call_llm(decompose_prompt, temperature=control_temp, top_p=top_p, top_k=top_k, stream=False)
-    subtasks_text = next(subtasks_text_gen, "Error: No response from decomposition.")
-    if subtasks_text.startswith("Error:") or subtasks_text.startswith("Network error:"):
-        yield "[Status] Decomposition failed. Answering directly..."
-        print(f"[Medium Mode] Decomposition failed: {subtasks_text}. Responding directly (streaming)...")
-        full_response = ""
-        for chunk in call_llm(user_input, chat_history_gradio=history, temperature=temperature, top_p=top_p, top_k=top_k, stream=True):
-            full_response += chunk
-            yield full_response
-        print("[Medium Mode] Direct response stream finished after decomposition failure.")
-        return
+NUMBERED_ITEM_PATTERN = re.compile(r"^\s*\d+\.\s*(.*)")
 
-    subtasks = re.findall(r"^\s*\d+\.\s*(.*)", subtasks_text, re.MULTILINE)
 
-    if not subtasks:
-        yield "[Status] Decomposition returned no subtasks. Answering directly..."
-        print("[Medium Mode] Decomposition returned no numbered points. Responding directly (streaming)...")
-        full_response = ""
-        for chunk in call_llm(user_input, chat_history_gradio=history, temperature=temperature, top_p=top_p, top_k=top_k, stream=True):
-            full_response += chunk
-            yield full_response
-        print("[Medium Mode] Direct response stream finished after no subtasks found.")
-        return
+class NumberedListParser:
+    def __init__(self):
+        self.buffer = ""
+        self.items = []
 
-    yield f"[Status] Task divided into {len(subtasks)} subtasks. Solving them one by one..."
-    print(f"[Medium Mode] Task divided into {len(subtasks)} subtasks.")
-    subtask_results = []
-    temp_history_medium = history.copy() if history else []
-
-    for i, subtask in enumerate(subtasks):
-        subtask = subtask.strip()
-        if not subtask: continue
-        yield f"[Status] Solving subtask {i+1}/{len(subtasks)}: \"{subtask}...\""
-        print(f"[Medium Mode] Solving subtask {i+1}/{len(subtasks)}: \"{subtask}\"...")
-        solve_prompt = f'Original overall task: "{user_input}". Current subtask: "{subtask}". Provide a detailed solution or answer for this specific subtask.'
-
-        subtask_result_gen = call_llm(solve_prompt, chat_history_gradio=temp_history_medium, temperature=temperature, top_p=top_p, top_k=top_k, stream=False)
-        subtask_result = next(subtask_result_gen, f"Error: No response for subtask {i+1}.")
-        subtask_results.append({"subtask": subtask, "result": subtask_result})
-        print(f"[Medium Mode] Subtask {i+1} result: Received.")
-        if subtask_result.startswith("Error:") or subtask_result.startswith("Network error:"):
-             yield f"[Status] Error solving subtask {i+1}. Aborting and attempting direct answer..."
-             print(f"[Medium Mode] Error solving subtask {i+1}: {subtask_result}. Responding directly (streaming)...")
-             full_response = ""
-             for chunk in call_llm(user_input, chat_history_gradio=history, temperature=temperature, top_p=top_p, top_k=top_k, stream=True):
-                 full_response += chunk
-                 yield full_response
-             print("[Medium Mode] Direct response stream finished after subtask error.")
-             return
-
-    yield "[Status] All subtasks solved. Synthesizing final response..."
-    print("[Medium Mode] Synthesizing final response (streaming)...")
-    synthesis_prompt = f'Original task: "{user_input}". The task was broken down and the results for each subtask are:\n---\n'
-    for i, res in enumerate(subtask_results):
-        synthesis_prompt += f"{i+1}. Subtask: {res['subtask']}\n   Result: {res['result']}\n---\n"
-    synthesis_prompt += "Combine these results into a single, coherent, well-formatted final response that directly addresses the original task. Do not just list the subtasks and results; synthesize them."
-
-    full_response = ""
-    for chunk in call_llm(synthesis_prompt, temperature=control_temp, top_p=top_p, top_k=top_k, stream=True):
-        full_response += chunk
-        yield full_response
-    print("[Medium Mode] Final response stream synthesized.")
-
-
-def high_compute(user_input, history, temperature, top_p, top_k):
-    yield "[Status] Starting task decomposition (Level 1)..."
-    print("[High Mode] Starting task decomposition (Level 1)...")
-    control_temp = max(0.1, temperature * 0.5)
-    decompose_prompt_l1 = f'Original complex task: "{user_input}". Break this down into major high-level stages or components (Level 1 - numbered list). Keep items distinct and logical.'
-
-    subtasks_l1_text_gen = call_llm(decompose_prompt_l1, temperature=control_temp, top_p=top_p, top_k=top_k, stream=False)
-    subtasks_l1_text = next(subtasks_l1_text_gen, "Error: No response from L1 decomposition.")
-
-    if subtasks_l1_text.startswith("Error:") or subtasks_l1_text.startswith("Network error:"):
-        yield "[Status] Level 1 decomposition failed. Falling back to Medium compute mode..."
-        print(f"[High Mode] Decomposition failed (Level 1): {subtasks_l1_text}. Falling back to Medium Mode...")
-        yield from medium_compute(user_input, history, temperature, top_p, top_k)
-        return
+    def feed(self, text):
+        self.buffer += text
+        if "\n" not in text:
+            return []
+        *lines, self.buffer = self.buffer.split("\n")
+        return self._parse(lines)
 
-    subtasks_l1 = re.findall(r"^\s*\d+\.\s*(.*)", subtasks_l1_text, re.MULTILINE)
+    def close(self):
+        lines, self.buffer = [self.buffer], ""
+        return self._parse(lines)
 
-    if not subtasks_l1:
-        yield "[Status] Level 1 decomposition returned no subtasks. Falling back to Medium compute mode..."
-        print("[High Mode] Decomposition returned no subtasks (Level 1). Falling back to Medium Mode...")
-        yield from medium_compute(user_input, history, temperature, top_p, top_k)
-        return
+    def _parse(self, lines):
+        new_items = []
+        for line in lines:
+            match = NUMBERED_ITEM_PATTERN.match(line)
+            if match and match.group(1).strip():
+                new_items.append(match.group(1).strip())
+        self.items.extend(new_items)
+        return new_items
 
-    yield f"[Status] Task divided into {len(subtasks_l1)} Level 1 stages. Processing stages..."
-    print(f"[High Mode] Task divided into {len(subtasks_l1)} Level 1 subtasks.")
-    subtasks_l1_results = []
-    temp_history_high = history.copy() if history else []
 
-    for i, subtask_l1 in enumerate(subtasks_l1):
-        subtask_l1 = subtask_l1.strip()
-        if not subtask_l1: continue
-        yield f"[Status] Processing Level 1 stage {i+1}/{len(subtasks_l1)}: \"{subtask_l1}...\". Starting mandatory Level 2 decomposition..."
-        print(f"[High Mode] Working on Level 1 subtask ({i+1}/{len(subtasks_l1)}): \"{subtask_l1}\"")
-        print(f"[High Mode]   Attempting MANDATORY Level 2 decomposition for: \"{subtask_l1}\"...")
+def is_llm_error(text):
+    return text.startswith("Error:") or text.startswith("Network error:")
 
-        decompose_prompt_l2 = f'Current high-level stage (Level 1): "{subtask_l1}". Break THIS stage down into smaller, actionable steps (Level 2 - numbered list). You MUST provide the steps as a numbered list starting with "1.". Even if there is only one step, write "1. {subtask_l1}". Do not use phrases like "No further decomposition needed". Just provide the list.'
 
-        subtasks_l2_text_gen = call_llm(decompose_prompt_l2, temperature=control_temp, top_p=top_p, top_k=top_k, stream=False)
-        subtasks_l2_text = next(subtasks_l2_text_gen, f"Error: No response for L2 decomposition of stage {i+1}.")
-        print(f"[DEBUG High Mode] Raw L2 decomposition text for '{subtask_l1}':\n>>>\n{subtasks_l2_text}\n<<<")
+SUBTASK_STOPWORDS = frozenset("a an the of for to and or in on with by its this that".split())
 
-        if subtasks_l2_text.startswith("Error:") or subtasks_l2_text.startswith("Network error:"):
-            yield f"[Status] Stage {i+1}: L2 decomposition failed ({subtasks_l2_text}). Forcing L1 task as single L2 step."
-            print(f"[High Mode]   L2 decomposition failed for \"{subtask_l1}\": {subtasks_l2_text}. Forcing it as a single L2 step.")
-            subtasks_l2 = [subtask_l1.strip()]
-        else:
-            subtasks_l2 = re.findall(r"^\s*\d+\.\s*(.*)", subtasks_l2_text, re.MULTILINE)
-            if not subtasks_l2:
-                yield f"[Status] Stage {i+1}: L2 decomposition format issue or LLM refusal. Forcing L1 task as single L2 step."
-                print(f"[High Mode]   L2 decomposition failed/refused for \"{subtask_l1}\". Forcing it as a single L2 step.")
-                subtasks_l2 = [subtask_l1.strip()]
-
-
-        yield f"[Status] Stage {i+1} processing {len(subtasks_l2)} Level 2 step(s)..."
-        print(f"[High Mode]   Processing {len(subtasks_l2)} Level 2 step(s) for L1 subtask \"{subtask_l1}\".")
-        subtasks_l2_results = []
-        abort_stage = False
-        for j, subtask_l2 in enumerate(subtasks_l2):
-            subtask_l2 = subtask_l2.strip()
-            if not subtask_l2: continue
-            yield f"[Status] Stage {i+1}/{len(subtasks_l1)}, Solving L2 step {j+1}/{len(subtasks_l2)}: \"{subtask_l2}...\""
-            print(f"[High Mode]     Solving Level 2 step ({j+1}/{len(subtasks_l2)}): \"{subtask_l2}\"...")
-
-            if len(subtasks_l2) == 1 and subtask_l2 == subtask_l1:
-                solve_prompt_l2 = f'Original task: "{user_input}".\nCurrent Level 1 stage: "{subtask_l1}".\nThis stage could not be broken down further. Solve this specific stage in detail.'
-            else:
-                 solve_prompt_l2 = f'Original task: "{user_input}".\nCurrent Level 1 stage: "{subtask_l1}".\nCurrent Level 2 step: "{subtask_l2}".\nSolve this specific Level 2 step in detail.'
-
-            result_l2_gen = call_llm(solve_prompt_l2, chat_history_gradio=temp_history_high, temperature=temperature, top_p=top_p, top_k=top_k, stream=False)
-            result_l2 = next(result_l2_gen, f"Error: No response for L2 step {j+1}.")
-            subtasks_l2_results.append({"subtask": subtask_l2, "result": result_l2})
-            print(f"[High Mode]     Level 2 step result ({j+1}): Received.")
-            if result_l2.startswith("Error:") or result_l2.startswith("Network error:"):
-                yield f"[Status] Error solving L2 step {j+1} in stage {i+1}. Aborting stage..."
-                print(f"[High Mode]   Error solving L2 step {j+1}: {result_l2}. Aborting stage {i+1}.")
-                subtasks_l1_results.append({"subtask": subtask_l1, "result": f"[Error processing stage {i+1}: {result_l2}]"})
-                abort_stage = True
-                break
 
-        if abort_stage:
-            continue
+def normalize_subtask(text):
+    words = re.sub(r"[^\w\s]|_", " ", text.lower()).split()
+    return " ".join(word for word in words if word not in SUBTASK_STOPWORDS)
 
 
-        yield f"[Status] Stage {i+1}: Synthesizing results from {len(subtasks_l2)} Level 2 step(s)..."
-        print(f"[High Mode]   Synthesizing Level 2 results for L1 subtask \"{subtask_l1}\"...")
-        result_l1_final = ""
-        if len(subtasks_l2_results) == 1:
-             result_l1_final = subtasks_l2_results[0]['result']
-             print(f"[High Mode]   Result for \"{subtask_l1}\" (from single L2 step): Received.")
+def emit_numbered_items(text, item_event_prefix, emit, max_items=None):
+    if is_llm_error(text):
+        return
+    parser = NumberedListParser()
+    parser.feed(text)
+    parser.close()
+    for k, item in enumerate(parser.items[:max_items]):
+        emit(item_event_prefix + (k,), item)
+
+
+def replay_decomposition(item_event_prefix, max_items=None):
+    return lambda text, emit: emit_numbered_items(text, item_event_prefix, emit, max_items)
+
+
+def make_decomposer(prompt, no_response_message, item_event_prefix, temperature, top_p, top_k, role="decompose", max_items=None):
+    def decompose(emit):
+        if not SPECULATIVE_DISPATCH:
+            decomposition_text = next(call_llm(prompt, temperature=temperature, top_p=top_p, top_k=top_k, stream=False, kind="decompose", role=role), no_response_message)
+            emit_numbered_items(decomposition_text, item_event_prefix, emit, max_items)
+            return decomposition_text
+
+        parser = NumberedListParser()
+        text_parts = []
+        emitted = 0
+        chunks = call_llm(prompt, temperature=temperature, top_p=top_p, top_k=top_k, stream=True, kind="decompose", role=role)
+        for chunk in chunks:
+            text_parts.append(chunk)
+            if is_llm_error(text_parts[0]):
+                continue
+            for item in parser.feed(chunk):
+                emit(item_event_prefix + (emitted,), item)
+                emitted += 1
+                if emitted == max_items:
+                    break
+            if emitted == max_items:
+                logger.info(f"Decomposition '{role}' reached the limit of {max_items} item(s); stopping the stream.")
+                chunks.close()
+                return "".join(text_parts).strip()
+        decomposition_text = "".join(text_parts).strip() or no_response_message
+        if not is_llm_error(decomposition_text):
+            for item in parser.close()[:None if max_items is None else max_items - emitted]:
+                emit(item_event_prefix + (emitted,), item)
+                emitted += 1
+        return decomposition_text
+    return decompose
+
+
+def estimate_prompt_tokens(prompt, history=None):
+    history_text = "".join((user_msg or "") + (assistant_msg or "") for user_msg, assistant_msg in history or [])
+    return estimate_tokens(history_text + prompt)
+
+
+def estimate_call_tokens(prompt, history=None):
+    return estimate_prompt_tokens(prompt, history) + ANSWER_TOKENS_ESTIMATE
+
+
+def subtask_cap(budget, reserve_calls, fallback_tokens=ANSWER_TOKENS_ESTIMATE):
+    caps = [cap for cap in (MAX_SUBTASKS or None, budget.affordable_calls(reserve_calls, fallback_tokens)) if cap is not None]
+    return min(caps) if caps else None
+
+
+class TaskGraph:
+    def __init__(self, max_workers=None):
+        self.max_workers = max(1, max_workers or MAX_PARALLEL_REQUESTS)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="llm-graph")
+        self.events = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.futures = {}
+        self.results = {}
+        self.discarded = set()
+
+    def add(self, node_id, fn, deps=(), streaming=False):
+        with self.lock:
+            self.pending[node_id] = (fn, tuple(deps), streaming)
+        self._submit_ready()
+
+    def discard(self, node_ids):
+        with self.lock:
+            for node_id in node_ids:
+                self.discarded.add(node_id)
+                self.pending.pop(node_id, None)
+                future = self.futures.pop(node_id, None)
+                if future is not None and future.cancel():
+                    self.events.put((node_id, None, None))
+
+    def _submit_ready(self):
+        with self.lock:
+            ready = [node_id for node_id, (fn, deps, streaming) in self.pending.items() if all(dep in self.results for dep in deps)]
+            for node_id in ready:
+                fn, deps, streaming = self.pending.pop(node_id)
+                args = []
+                if deps:
+                    args.append({dep: self.results[dep] for dep in deps})
+                if streaming:
+                    args.append(lambda event_id, value, node_id=node_id: self.events.put((node_id, event_id, value)))
+                self.futures[node_id] = self.executor.submit(contextvars.copy_context().run, self._run_node, node_id, fn, args)
+
+    def _run_node(self, node_id, fn, args):
+        try:
+            result = fn(*args)
+        except Exception as e:
+            logger.error(f"Error in task graph node {node_id}: {e}")
+            result = f"Error: {e}"
+        self.events.put((node_id, None, result))
+
+    def run(self):
+        try:
+            while True:
+                with self.lock:
+                    if not self.futures:
+                        if self.pending:
+                            logger.warning(f"Task graph finished with unresolved nodes: {list(self.pending)}")
+                        return
+                node_id, event_id, value = self.events.get()
+                with self.lock:
+                    if node_id in self.discarded:
+                        self.futures.pop(node_id, None)
+                        continue
+                    if event_id is None:
+                        self.futures.pop(node_id, None)
+                        self.results[node_id] = value
+                if event_id is not None:
+                    yield event_id, value
+                    continue
+                yield node_id, value
+                self._submit_ready()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+        self.executor.shutdown(wait=False)
+
+
+def task_prefix(user_input):
+    return f'Original task: "{user_input}".\n'
+
+
+def prefix_cache_key(messages):
+    shared_part = json.dumps(messages[:-1], ensure_ascii=False) + messages[-1]["content"].split("\n", 1)[0]
+    return hashlib.sha256(shared_part.encode("utf-8")).hexdigest()[:32]
+
+
+def prepare_history(history):
+    history = [list(turn) for turn in history] if history else []
+    if HISTORY_TOKEN_BUDGET <= 0:
+        return history
+    kept = []
+    used_tokens = 0
+    for turn in reversed(history):
+        turn_tokens = estimate_tokens((turn[0] or "") + (turn[1] or ""))
+        if kept and used_tokens + turn_tokens > HISTORY_TOKEN_BUDGET:
+            break
+        kept.append(turn)
+        used_tokens += turn_tokens
+    kept.reverse()
+    dropped = history[:len(history) - len(kept)]
+    if not dropped:
+        return history
+    logger.info(f"History trimmed to the last {len(kept)} turn(s) (~{used_tokens} tokens); {len(dropped)} older turn(s) dropped.")
+    if HISTORY_SUMMARIZE:
+        transcript = "\n".join(f"User: {user_msg or ''}\nAssistant: {assistant_msg or ''}" for user_msg, assistant_msg in dropped)
+        summary_prompt = f"Summarize the following earlier part of a conversation in a few concise sentences. Keep facts, decisions and open questions that later messages may refer to.\n---\n{transcript}"
+        summary = next(call_llm(summary_prompt, temperature=0.2, stream=False, kind="summary", role="history summary"), "")
+        if summary and not is_llm_error(summary):
+            kept.insert(0, [f"Summary of our earlier conversation: {summary}", "Understood."])
+    return kept
+
+
+def sample_llm(prompt, n, chat_history_gradio=None, temperature=0.7, top_p=None, top_k=None, kind="solve", role=None, max_tokens=None):
+    role = role or kind
+    samples = []
+    if not all(endpoint.supports_n is False for endpoint in get_router().endpoints):
+        samples = list(call_llm(prompt, chat_history_gradio=chat_history_gradio, temperature=temperature, top_p=top_p, top_k=top_k, stream=False, kind=kind, role=role, max_tokens=max_tokens, n=n))
+        if not samples or (len(samples) == 1 and is_llm_error(samples[0])):
+            return samples or [f"Error: No response for {role}."]
+    slots = current_sample_slots.get() or threading.BoundedSemaphore(MAX_PARALLEL_REQUESTS)
+
+    def make_sample(index):
+        def sample():
+            with slots:
+                return next(call_llm(prompt, chat_history_gradio=chat_history_gradio, temperature=temperature, top_p=top_p, top_k=top_k, stream=False, kind=kind, role=f"{role} sample {index + 1}", max_tokens=max_tokens, n=1), f"Error: No response for {role} sample {index + 1}.")
+        return sample
+
+    extra = dict(run_in_parallel([make_sample(index) for index in range(len(samples), n)], max_workers=min(n - len(samples), MAX_PARALLEL_REQUESTS)))
+    return samples + [extra[index] for index in sorted(extra)]
+
+
+def sample_agreement(samples):
+    word_sets = [set(re.findall(r"\w+", sample.lower())) for sample in samples]
+    scores = []
+    for i, words in enumerate(word_sets):
+        similarities = [len(words & other) / len(words | other) if words | other else 1.0 for j, other in enumerate(word_sets) if j != i]
+        scores.append(sum(similarities) / len(similarities) if similarities else 1.0)
+    return scores
+
+
+def select_sample(prompt, samples, chat_history_gradio=None, temperature=0.7, top_p=None, top_k=None, role=None):
+    valid = [i for i, sample in enumerate(samples) if not is_llm_error(sample)]
+    if len(valid) <= 1:
+        return (valid or [0])[0], f"used the only successful sample of {len(samples)}" if valid else "all samples failed"
+    candidates = [samples[i] for i in valid]
+    scores = sample_agreement(candidates)
+    best = max(range(len(candidates)), key=scores.__getitem__)
+    how = f"picked sample {valid[best] + 1} of {len(samples)} by agreement ({scores[best]:.0%} word overlap with the others)"
+    if SAMPLE_SELECTION == "judge":
+        judge_prompt = prompt + "\n\n---\nSeveral candidate answers to the request above were written:\n---\n"
+        for i, candidate in enumerate(candidates):
+            judge_prompt += f"Candidate {i+1}:\n{candidate}\n---\n"
+        judge_prompt += "Which candidate answers the request best: correct, complete and consistent with the others where they agree? Reply with the number of the best candidate only."
+        verdict = next(call_llm(judge_prompt, chat_history_gradio=chat_history_gradio, temperature=max(0.1, temperature * 0.5), top_p=top_p, top_k=top_k, stream=False, kind="judge", role=f"{role} judge", max_tokens=16), "")
+        match = re.search(r"\d+", verdict) if not is_llm_error(verdict) else None
+        if match and 1 <= int(match.group()) <= len(candidates):
+            best = int(match.group()) - 1
+            how = f"picked sample {valid[best] + 1} of {len(samples)} by LLM judge"
         else:
-            synthesis_prompt_l2 = f'The goal for this stage was: "{subtask_l1}". The results for the Level 2 steps taken are:\n---\n'
-            for j, res_l2 in enumerate(subtasks_l2_results):
-                synthesis_prompt_l2 += f"{j+1}. Step: {res_l2['subtask']}\n   Result: {res_l2['result']}\n---\n"
-            synthesis_prompt_l2 += f'Synthesize these results into a single, coherent answer for the Level 1 stage: "{subtask_l1}". Focus on fulfilling the goal of this stage.'
-
-            result_l1_final_gen = call_llm(synthesis_prompt_l2, temperature=control_temp, top_p=top_p, top_k=top_k, stream=False)
-            result_l1_final = next(result_l1_final_gen, f"Error: No response for L1 synthesis stage {i+1}.")
-            print(f"[High Mode]   Result for \"{subtask_l1}\" (synthesized from L2): Received.")
-            if result_l1_final.startswith("Error:") or result_l1_final.startswith("Network error:"):
-                 yield f"[Status] Error synthesizing L2 results for stage {i+1}. Using raw results..."
-                 print(f"[High Mode]   Error synthesizing L2 results for stage {i+1}: {result_l1_final}. Using raw results.")
-                 result_l1_final = "\n".join([f"Step {j+1}: {res['subtask']}\nResult: {res['result']}" for j, res in enumerate(subtasks_l2_results)])
+            logger.warning(f"Judge for '{role}' gave no valid choice ({verdict[:80]!r}); falling back to agreement.")
+    return valid[best], how
+
+
+def best_of_samples(prompt, chat_history_gradio=None, temperature=0.7, top_p=None, top_k=None, kind="solve", role=None, max_tokens=None):
+    if max_tokens is not None:
+        max_tokens = max(64, max_tokens // SAMPLE_COUNT)
+    samples = sample_llm(prompt, SAMPLE_COUNT, chat_history_gradio, temperature, top_p, top_k, kind, role, max_tokens)
+    index, how = select_sample(prompt, samples, chat_history_gradio, temperature, top_p, top_k, role or kind)
+    logger.info(f"Request '{role or kind}': {how}.")
+    return samples[index], how
+
+
+def answer_directly(user_input, history, temperature, top_p, top_k):
+    max_tokens = get_budget().max_tokens_for(estimate_prompt_tokens(user_input, history))
+    if SAMPLE_COUNT > 1 and "direct" in SAMPLE_KINDS:
+        yield f"[Status] Sampling {SAMPLE_COUNT} answers and picking the best one..."
+        answer, how = best_of_samples(user_input, history, temperature, top_p, top_k, kind="direct", role="direct answer", max_tokens=max_tokens)
+        yield f"[Status] {how[0].upper() + how[1:]}."
+        yield answer
+        return
+    yield from call_llm(user_input, chat_history_gradio=history, temperature=temperature, top_p=top_p, top_k=top_k, stream=True, kind="direct", role="direct answer", max_tokens=max_tokens)
 
 
-        subtasks_l1_results.append({"subtask": subtask_l1, "result": result_l1_final})
+def low_compute(user_input, history, temperature, top_p, top_k):
+    history = prepare_history(history)
+    yield "[Status] Sending request directly to LLM..."
+    logger.info("[Low Mode] Sending LLM request (streaming)...")
+    yield from answer_directly(user_input, history, temperature, top_p, top_k)
+    logger.info("[Low Mode] Response stream finished.")
+
+
+class TreeNode:
+    def __init__(self, path, text="", parent=None):
+        self.path = path
+        self.text = text
+        self.parent = parent
+        self.key = normalize_subtask(text) if parent is not None else None
+        self.children = []
+        self.skipped = []
+        self.max_children = None
+        self.truncated = False
+        self.decomposed = False
+        self.forced = False
+        self.synthesizing = False
+        self.deferred = None
+        self.canonical = None
+        self.aliases = []
+        self.done = False
+        self.abandoned = False
+        self.result = None
+
+    @property
+    def level(self):
+        return len(self.path)
+
+    @property
+    def label(self):
+        return ".".join(str(k + 1) for k in self.path)
+
+    def lineage(self):
+        nodes = []
+        node = self
+        while node.parent is not None:
+            nodes.append(node)
+            node = node.parent
+        return nodes[::-1]
+
+    def descendants(self):
+        for child in self.children:
+            yield child
+            yield from child.descendants()
+
+
+class DecompositionTree:
+    def __init__(self, name, fan_outs, user_input, history, temperature, top_p, top_k, checkpoint):
+        self.name = name
+        self.fan_outs = list(fan_outs)
+        self.depth = len(self.fan_outs)
+        self.history = history
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.control_temp = max(0.1, temperature * 0.5)
+        self.checkpoint = checkpoint
+        self.budget = get_budget()
+        self.synthesis_batch_tokens = get_synthesis_batch_tokens()
+        self.prefix = task_prefix(user_input)
+        self.call_tokens = estimate_call_tokens(self.prefix, history)
+        self.root = TreeNode(())
+        self.nodes = {(): self.root}
+        self.registry = {}
+        self.fan_out_counts = []
+        self.duplicates = 0
+        self.statuses = []
+        self.root_text = None
+        self.failed = None
+        self.graph = None
+
+    def noun(self, level):
+        if self.depth == 1:
+            return "subtask"
+        return "stage" if level == 1 else "step"
+
+    def total(self, node):
+        return len(node.children) if node.decomposed else "?"
+
+    def status(self, message):
+        self.statuses.append(f"[Status] {message}")
+
+    def static_cap(self, level, cap=None):
+        caps = [limit for limit in (self.fan_outs[level], cap, MAX_SUBTASKS or None) if limit is not None]
+        return min(caps) if caps else None
+
+    def child_limit(self, node):
+        static_cap = self.static_cap(node.level)
+        affordable = self.budget.affordable_calls(1, self.call_tokens)
+        if affordable is None:
+            return static_cap, True
+        expected_fan_out = sum(self.fan_out_counts) / len(self.fan_out_counts) if self.fan_out_counts else min(static_cap or FAN_OUT_ESTIMATE, FAN_OUT_ESTIMATE)
+        child_calls = 1
+        for _ in range(self.depth - node.level - 1):
+            child_calls = 2 + expected_fan_out * child_calls
+        parent = node.parent
+        position = parent.children.index(node)
+        expected_siblings = len(parent.children) if parent.decomposed else max(position + 1, min(parent.max_children or FAN_OUT_ESTIMATE, FAN_OUT_ESTIMATE))
+        share = affordable / max(1, expected_siblings - position)
+        max_children = int((share - 2) / child_calls)
+        if static_cap is not None:
+            max_children = min(max_children, static_cap)
+        return max_children, share >= 2 + expected_fan_out * child_calls and max_children >= 1
+
+    def decompose_prompt(self, node):
+        if node is self.root:
+            if self.depth == 1:
+                return self.prefix + 'Break it down into logical subtasks needed to solve it (numbered list). Be concise.'
+            return self.prefix + 'This is a complex task. Break it down into major high-level stages or components (Level 1 - numbered list). Keep items distinct and logical.'
+        context = "".join(f'Current Level {n.level} {self.noun(n.level)}: "{n.text}".\n' for n in node.lineage()[:-1])
+        current = "high-level stage" if node.level == 1 else self.noun(node.level)
+        return self.prefix + context + f'Current {current} (Level {node.level}): "{node.text}". Break THIS {self.noun(node.level)} down into smaller, actionable steps (Level {node.level + 1} - numbered list). You MUST provide the steps as a numbered list starting with "1.". Even if there is only one step, write "1. {node.text}". Do not use phrases like "No further decomposition needed". Just provide the list.'
+
+    def solve_prompt(self, node):
+        if self.depth == 1:
+            return self.prefix + f'Current subtask: "{node.text}". Provide a detailed solution or answer for this specific subtask.'
+        context = "".join(f'Current Level {n.level} {self.noun(n.level)}: "{n.text}".\n' for n in node.lineage())
+        if node.forced:
+            return self.prefix + context + f'This {self.noun(node.level)} could not be broken down further. Solve this specific {self.noun(node.level)} in detail.'
+        return self.prefix + context + f'Solve this specific Level {node.level} {self.noun(node.level)} in detail.'
+
+    def synthesis_prompt(self, node, results):
+        context = "".join(f'Current Level {n.level} {self.noun(n.level)}: "{n.text}".\n' for n in node.lineage()[:-1])
+        prompt = self.prefix + context + f'The goal for this {self.noun(node.level)} was: "{node.text}". The results for the Level {node.level + 1} steps taken are:\n---\n'
+        for j, (step, result) in enumerate(results):
+            prompt += self.result_entry(node, j, step, result)
+        return prompt + f'Synthesize these results into a single, coherent answer for the Level {node.level} {self.noun(node.level)}: "{node.text}". Focus on fulfilling the goal of this {self.noun(node.level)}.'
+
+    def result_entry(self, node, index, title, result):
+        if node is not self.root:
+            return f"{index+1}. Step: {title}\n   Result: {result}\n---\n"
+        if self.depth == 1:
+            return f"{index+1}. Subtask: {title}\n   Result: {result}\n---\n"
+        return f"{index+1}. Stage: {title}\n   Overall Result for Stage: {result}\n---\n"
+
+    def merge_prompt(self, node, group):
+        if node is self.root:
+            prompt = self.prefix + f'The task was broken down and its results are being combined in parts. These are the results for {len(group)} of its {self.noun(1)}s:\n---\n'
+        else:
+            context = "".join(f'Current Level {n.level} {self.noun(n.level)}: "{n.text}".\n' for n in node.lineage()[:-1])
+            prompt = self.prefix + context + f'The goal for this {self.noun(node.level)} was: "{node.text}". Its results are being combined in parts. These are the results for {len(group)} of its Level {node.level + 1} steps:\n---\n'
+        for i, (title, result) in enumerate(group):
+            prompt += self.result_entry(node, i, title, result)
+        return prompt + "Merge these results into one coherent intermediate result. Keep every fact, decision, figure and open question that matters for the goal, and remove repetition. Do not write an introduction or a conclusion: this will be combined with the results of the other parts afterwards."
+
+    def merge_results(self, node, results):
+        batch_tokens = self.synthesis_batch_tokens
+        scope = "final" if node is self.root else f"L{node.level} {self.noun(node.level)} {node.label}"
+        merge_round = 0
+        while batch_tokens > 0 and len(results) > 1:
+            sizes = [estimate_tokens(self.result_entry(node, i, title, result)) for i, (title, result) in enumerate(results)]
+            if sum(sizes) <= batch_tokens:
+                break
+            groups = []
+            group_tokens = 0
+            for entry, size in zip(results, sizes):
+                if groups and group_tokens + size <= batch_tokens:
+                    groups[-1].append(entry)
+                    group_tokens += size
+                else:
+                    groups.append([entry])
+                    group_tokens = size
+            merges = [index for index, group in enumerate(groups) if len(group) > 1]
+            if not merges:
+                logger.info(f"[{self.name} Mode] No two {scope} synthesis results fit into one batch of {batch_tokens} tokens; synthesizing them in one pass.")
+                yield "[Status] The results cannot be grouped further within the synthesis batch size. Synthesizing them in one pass..."
+                break
+            if not self.budget.can_afford(len(merges), 1, self.call_tokens + batch_tokens):
+                self.budget.note(f"Skipped merging {len(results)} {scope} synthesis results in groups to stay within the budget.")
+                break
+            merge_round += 1
+            logger.info(f"[{self.name} Mode] {scope.capitalize()} synthesis results take ~{sum(sizes)} tokens; merging {len(results)} results in {len(merges)} group(s) of at most {batch_tokens} tokens (round {merge_round})...")
+            yield f"[Status] Results exceed the synthesis batch size (~{sum(sizes):,}/{batch_tokens:,} tokens). Merging them in {len(merges)} group(s) (round {merge_round})..."
+
+            def make_merge(index, group):
+                prompt = self.merge_prompt(node, group)
+                role = f"{scope} merge round {merge_round} group {index + 1}"
+                max_tokens = [limit for limit in (batch_tokens, self.budget.max_tokens_for(estimate_tokens(prompt))) if limit is not None]
+                def merge():
+                    return next(call_llm(prompt, temperature=self.control_temp, top_p=self.top_p, top_k=self.top_k, stream=False, kind="synthesis", role=role, max_tokens=min(max_tokens)), f"Error: No response for {role}.")
+                return merge
+
+            merged = [group[0] for group in groups]
+            tasks = [make_merge(index, groups[index]) for index in merges]
+            for done, (position, text) in enumerate(run_in_parallel(tasks, max_workers=None if node is self.root else 1), 1):
+                group = groups[merges[position]]
+                if is_llm_error(text):
+                    logger.warning(f"[{self.name} Mode] Merging {scope} group {merges[position] + 1} failed ({text}); keeping its results as they are.")
+                    text = "\n\n".join(result for _, result in group)
+                merged[merges[position]] = ("; ".join(title for title, _ in group), text)
+                yield f"[Status] Merged group {done}/{len(merges)} (round {merge_round})."
+            results = merged
+        return results
+
+    def add_decomposition(self, node):
+        node_id = ("decompose",) + node.path
+        item_prefix = ("item",) + node.path
+        if node is self.root:
+            role = "decompose" if self.depth == 1 else "L1 decompose"
+            no_response_message = "Error: No response from decomposition."
+        else:
+            role = f"L{node.level + 1} decompose {self.noun(node.level)} {node.label}"
+            no_response_message = f"Error: No response for L{node.level + 1} decomposition of {self.noun(node.level)} {node.label}."
+        decompose = make_decomposer(self.decompose_prompt(node), no_response_message, item_prefix, self.control_temp, self.top_p, self.top_k, role=role, max_items=node.max_children)
+        fingerprint = json.dumps([n.text for n in node.lineage()], ensure_ascii=False) if node is not self.root else ""
+        self.graph.add(node_id, self.checkpoint.wrap(node_id, decompose, fingerprint=fingerprint, replay=replay_decomposition(item_prefix, node.max_children)), streaming=True)
+
+    def add_solve(self, node):
+        node_id = ("solve",) + node.path
+        prompt = self.solve_prompt(node)
+        role = f"subtask {node.label}" if self.depth == 1 else f"L{node.level} {self.noun(node.level)} {node.label}"
+        def solve():
+            logger.info(f"[{self.name} Mode] Solving {self.noun(node.level)} {node.label}: \"{node.text}\"...")
+            if SAMPLE_COUNT > 1 and "solve" in SAMPLE_KINDS:
+                return best_of_samples(prompt, self.history, self.temperature, self.top_p, self.top_k, kind="solve", role=role)[0]
+            return next(call_llm(prompt, chat_history_gradio=self.history, temperature=self.temperature, top_p=self.top_p, top_k=self.top_k, stream=False, kind="solve", role=role), f"Error: No response for {self.noun(node.level)} {node.label}.")
+        fingerprint = json.dumps([n.text for n in node.lineage()] + [node.forced], ensure_ascii=False)
+        self.graph.add(node_id, self.checkpoint.wrap(node_id, solve, fingerprint=fingerprint))
+
+    def add_synthesis(self, node):
+        node_id = ("synthesize",) + node.path
+        results = [(child.text, child.result) for child in node.children]
+        def synthesize():
+            merging = self.merge_results(node, results)
+            while True:
+                try:
+                    next(merging)
+                except StopIteration as done:
+                    prompt = self.synthesis_prompt(node, done.value)
+                    break
+            logger.info(f"[{self.name} Mode]   Synthesizing Level {node.level + 1} results for {self.noun(node.level)} {node.label}...")
+            return next(call_llm(prompt, temperature=self.control_temp, top_p=self.top_p, top_k=self.top_k, stream=False, kind="synthesis", role=f"L{node.level} synthesis {self.noun(node.level)} {node.label}"), f"Error: No response for L{node.level} synthesis {self.noun(node.level)} {node.label}.")
+        fingerprint = json.dumps([n.text for n in node.lineage()] + [[child.text, child.result] for child in node.children], ensure_ascii=False)
+        self.graph.add(node_id, self.checkpoint.wrap(node_id, synthesize, fingerprint=fingerprint))
+
+    def run(self):
+        self.graph = TaskGraph()
+        self.add_decomposition(self.root)
+        try:
+            for event_id, result in self.graph.run():
+                kind, path = event_id[0], event_id[1:]
+                if kind == "item":
+                    self.on_item(self.nodes[path[:-1]], path, result)
+                elif kind == "decompose":
+                    self.on_decomposed(self.nodes[path], result)
+                elif kind == "solve":
+                    self.on_solved(self.nodes[path], result)
+                else:
+                    self.on_synthesized(self.nodes[path], result)
+                yield from self.statuses
+                self.statuses = []
+                if self.failed is not None or (kind == "decompose" and not path and (is_llm_error(result) or not self.root.children)):
+                    break
+                if self.budget.out_of_time():
+                    self.budget.stopped_early = True
+                    done = sum(child.done for child in self.root.children)
+                    self.budget.note(f"Time budget nearly used up after {done}/{len(self.root.children)} {self.noun(1)}(s); synthesizing what is done.")
+                    break
+        finally:
+            self.graph.shutdown()
+
+    def on_item(self, parent, path, text):
+        if parent.done or parent.abandoned:
+            return
+        if path[-1] > 0 and (parent.truncated or not self.budget.can_afford(1, 1, self.call_tokens)):
+            kept = len(parent.children) + (parent.deferred is not None)
+            if not parent.truncated:
+                parent.truncated = True
+                if parent is self.root:
+                    self.budget.note(f"Stopped dispatching {self.noun(1)}s after {kept}; the remaining ones are left to the final synthesis.")
+                else:
+                    self.budget.note(f"{self.noun(parent.level).capitalize()} {parent.label} limited to {kept} Level {parent.level + 1} step(s) to stay within the budget.")
+            if parent is self.root:
+                parent.skipped.append(text)
+                self.status(f"Budget limit: {self.noun(1)} \"{text}...\" will not be {'solved' if self.depth == 1 else 'processed'} separately.")
+            return
+        key = normalize_subtask(text)
+        if parent is not self.root and key == parent.key and not parent.children and parent.deferred is None:
+            parent.deferred = (path, text)
+            return
+        if parent.deferred is not None:
+            deferred_path, deferred_text = parent.deferred
+            parent.deferred = None
+            self.add_child(parent, deferred_path, deferred_text)
+        if DEDUP_SUBTASKS and key and any(child.key == key for child in parent.children):
+            self.duplicates += 1
+            self.status(f"Skipped {self.noun(len(path))} {'.'.join(str(k + 1) for k in path)}: it repeats an earlier item of the same list.")
+            return
+        self.add_child(parent, path, text)
+
+    def waits_on(self, node, targets):
+        stack = [node]
+        seen = set()
+        while stack:
+            current = stack.pop()
+            if current.done or current in seen:
+                continue
+            if current in targets:
+                return True
+            seen.add(current)
+            stack.extend(current.children)
+            if current.canonical is not None:
+                stack.append(current.canonical)
+        return False
+
+    def add_child(self, parent, path, text):
+        child = TreeNode(path, text, parent)
+        parent.children.append(child)
+        parent.children.sort(key=lambda node: node.path)
+        self.nodes[path] = child
+        canonical = self.registry.get(child.key) if DEDUP_SUBTASKS and child.key else None
+        if canonical is not None and not self.waits_on(canonical, set(child.lineage())):
+            child.canonical = canonical
+            canonical.aliases.append(child)
+            self.duplicates += 1
+            logger.info(f"[{self.name} Mode] {self.noun(child.level).capitalize()} {child.label} duplicates {self.noun(canonical.level)} {canonical.label}; sharing its result.")
+            self.status(f"{self.noun(child.level).capitalize()} {child.label} repeats {self.noun(canonical.level)} {canonical.label} (\"{text}...\"); its result will be reused.")
+            if canonical.done:
+                self.finish(child, canonical.result)
+            return
+        self.registry.setdefault(child.key, child)
+        self.start(child)
+
+    def start(self, node):
+        if node.level == self.depth:
+            self.add_solve(node)
+            if node.parent is self.root:
+                self.status(f"Dispatched {self.noun(1)} {node.label}: \"{node.text}...\"")
+            return
+        logger.info(f"[{self.name} Mode] Queueing Level {node.level} {self.noun(node.level)} {node.label}: \"{node.text}\"")
+        max_children, decompose = self.child_limit(node)
+        if not decompose:
+            self.budget.note(f"{self.noun(node.level).capitalize()} {node.label} solved without Level {node.level + 1} decomposition to stay within the budget.")
+            self.status(f"Processing Level {node.level} {self.noun(node.level)} {node.label}: \"{node.text}...\". Solving it directly to stay within the budget...")
+            node.decomposed = True
+            node.forced = True
+            self.add_solve(node)
+            return
+        node.max_children = max_children
+        self.status(f"Processing Level {node.level} {self.noun(node.level)} {node.label}: \"{node.text}...\". Starting mandatory Level {node.level + 1} decomposition...")
+        self.add_decomposition(node)
+
+    def on_decomposed(self, node, text):
+        if node.done or node.abandoned:
+            return
+        node.decomposed = True
+        if node is self.root:
+            self.root_text = text
+            if is_llm_error(text) or not node.children:
+                return
+            if node.max_children is not None and len(node.children) + len(node.skipped) >= node.max_children:
+                self.budget.note(f"Decomposition capped at {node.max_children} {self.noun(1)}(s).")
+            if self.depth == 1:
+                self.status(f"Task divided into {len(node.children)} subtasks. Solving up to {MAX_PARALLEL_REQUESTS} at a time...")
+            else:
+                self.status(f"Task divided into {len(node.children)} Level 1 stages. Processing stages in parallel (up to {MAX_PARALLEL_REQUESTS} requests at a time)...")
+            logger.info(f"[{self.name} Mode] Task divided into {len(node.children)} Level 1 {self.noun(1)}s.")
+            return
+        logger.debug(f"[{self.name} Mode] Raw L{node.level + 1} decomposition text for '{node.text}':\n>>>\n{text}\n<<<")
+        self.fan_out_counts.append(len(node.children) + (node.deferred is not None))
+        noun = self.noun(node.level)
+        if is_llm_error(text) or not (node.children or node.deferred):
+            if is_llm_error(text):
+                self.status(f"{noun.capitalize()} {node.label}: L{node.level + 1} decomposition failed ({text}). Forcing it as a single L{node.level + 1} step.")
+                logger.info(f"[{self.name} Mode]   L{node.level + 1} decomposition failed for \"{node.text}\": {text}. Forcing it as a single step.")
+            else:
+                self.status(f"{noun.capitalize()} {node.label}: L{node.level + 1} decomposition format issue or LLM refusal. Forcing it as a single L{node.level + 1} step.")
+                logger.info(f"[{self.name} Mode]   L{node.level + 1} decomposition failed/refused for \"{node.text}\". Forcing it as a single step.")
+            self.abandon_descendants(node)
+            node.children = []
+            node.deferred = None
+            node.forced = True
+            self.add_solve(node)
+            return
+        if node.deferred is not None and not node.children:
+            node.deferred = None
+            node.forced = True
+            self.add_solve(node)
+        elif node.deferred is not None:
+            deferred_path, deferred_text = node.deferred
+            node.deferred = None
+            self.add_child(node, deferred_path, deferred_text)
+        steps = len(node.children) or 1
+        self.status(f"{noun.capitalize()} {node.label}/{self.total(node.parent)} processing {steps} Level {node.level + 1} step(s)...")
+        logger.info(f"[{self.name} Mode]   Processing {steps} Level {node.level + 1} step(s) for {noun} \"{node.text}\".")
+        self.check_complete(node)
+
+    def on_solved(self, node, result):
+        if node.done or node.abandoned:
+            return
+        logger.info(f"[{self.name} Mode] Result for {self.noun(node.level)} {node.label}: Received.")
+        if is_llm_error(result):
+            target = node if node.forced else node.parent
+            if target is self.root:
+                self.failed = node
+                node.result = result
+                return
+            self.status(f"Error solving {self.noun(node.level)} {node.label}. Aborting {self.noun(target.level)} {target.label}...")
+            logger.info(f"[{self.name} Mode]   Error solving {self.noun(node.level)} {node.label}: {result}. Aborting {self.noun(target.level)} {target.label}.")
+            self.abandon_descendants(target)
+            self.finish(target, f"[Error processing {self.noun(target.level)} {target.label}: {result}]")
+            return
+        self.finish(node, result)
+
+    def on_synthesized(self, node, result):
+        if node.done or node.abandoned:
+            return
+        logger.info(f"[{self.name} Mode]   Result for \"{node.text}\" (synthesized from L{node.level + 1}): Received.")
+        if is_llm_error(result):
+            self.status(f"Error synthesizing L{node.level + 1} results for {self.noun(node.level)} {node.label}. Using raw results...")
+            logger.info(f"[{self.name} Mode]   Error synthesizing L{node.level + 1} results for {self.noun(node.level)} {node.label}: {result}. Using raw results.")
+            result = "\n".join(f"Step {j+1}: {child.text}\nResult: {child.result}" for j, child in enumerate(node.children))
+        self.finish(node, result)
+
+    def finish(self, node, result):
+        if node.done or node.abandoned:
+            return
+        node.done = True
+        node.result = result
+        parent = node.parent
+        done = sum(child.done for child in parent.children)
+        if parent is self.root:
+            total = self.total(parent)
+            if self.depth == 1:
+                self.status(f"Solved subtask {node.label}/{total} ({done}/{total} done): \"{node.text}...\"")
+            else:
+                self.status(f"{self.noun(node.level).capitalize()} {node.label}/{total} complete ({done}/{total} {self.noun(node.level)}s done).")
+        elif parent.decomposed:
+            self.status(f"{self.noun(parent.level).capitalize()} {parent.label}/{self.total(parent.parent)}: finished Level {node.level} {self.noun(node.level)} {node.label} ({done}/{len(parent.children)} steps done).")
+        else:
+            self.status(f"{self.noun(parent.level).capitalize()} {parent.label}: finished Level {node.level} {self.noun(node.level)} {node.label} ({done} step(s) done, decomposition still streaming).")
+        for alias in node.aliases:
+            self.finish(alias, result)
+        if parent is not self.root:
+            self.check_complete(parent)
+
+    def check_complete(self, node):
+        if node.done or node.abandoned or node.forced or node.synthesizing or not node.decomposed or node.deferred is not None:
+            return
+        if not all(child.done for child in node.children):
+            return
+        if len(node.children) == 1:
+            self.finish(node, node.children[0].result)
+            return
+        node.synthesizing = True
+        self.status(f"{self.noun(node.level).capitalize()} {node.label}: Synthesizing results from {len(node.children)} Level {node.level + 1} step(s)...")
+        self.add_synthesis(node)
+
+    def abandon_descendants(self, node):
+        descendants = list(node.descendants())
+        for descendant in descendants:
+            if descendant.done or descendant.abandoned:
+                continue
+            descendant.abandoned = True
+            self.graph.discard([(kind,) + descendant.path for kind in ("decompose", "solve", "synthesize")])
+            if self.registry.get(descendant.key) is descendant:
+                del self.registry[descendant.key]
+            live_aliases = [alias for alias in descendant.aliases if not alias.done and not alias.abandoned and node not in alias.lineage()]
+            if live_aliases:
+                promoted, *others = live_aliases
+                promoted.canonical = None
+                promoted.aliases.extend(others)
+                for alias in others:
+                    alias.canonical = promoted
+                self.registry.setdefault(promoted.key, promoted)
+                self.start(promoted)
+
+    def partial_result(self, node):
+        parts = []
+        for j, child in enumerate(node.children):
+            if child.done:
+                parts.append(f"Step {j+1}: {child.text}\nResult: {child.result}")
+            else:
+                partial = self.partial_result(child)
+                if partial:
+                    parts.append(f"Step {j+1}: {child.text}\nResult: [Partial] {partial}")
+        return "\n".join(parts)
+
+
+def make_tree_compute(name, fan_outs, fallback=None):
+    depth = len(fan_outs)
+
+    def tree_compute(user_input, history, temperature, top_p, top_k):
+        yield f"[Status] Starting task decomposition ({depth} level{'s' if depth > 1 else ''})..."
+        logger.info(f"[{name} Mode] Starting task decomposition ({depth} level(s))...")
+        budget = get_budget()
+        checkpoint = open_checkpoint(name, user_input, history, temperature, top_p, top_k)
+        if checkpoint.nodes:
+            yield f"[Status] Resuming from checkpoint: {len(checkpoint.nodes)} completed step(s) will be reused..."
+        history = prepare_history(history)
+        tree = DecompositionTree(name, fan_outs, user_input, history, temperature, top_p, top_k, checkpoint)
+        root = tree.root
+        root.max_children = tree.static_cap(0, subtask_cap(budget, 2, tree.call_tokens))
+        if root.max_children == 0:
+            budget.note("Budget too small for decomposition; answered directly.")
+            yield "[Status] Budget too small for decomposition. Answering directly..."
+            yield from answer_directly(user_input, history, temperature, top_p, top_k)
+            return
+        yield from tree.run()
+
+        if tree.failed is not None:
+            yield f"[Status] Error solving subtask {tree.failed.label}. Aborting and attempting direct answer..."
+            logger.info(f"[{name} Mode] Error solving subtask {tree.failed.label}: {tree.failed.result}. Responding directly (streaming)...")
+            yield from answer_directly(user_input, history, temperature, top_p, top_k)
+            return
+
+        results = []
+        unprocessed = []
+        for child in root.children:
+            if child.done:
+                results.append((child.text, child.result))
+                continue
+            partial = tree.partial_result(child)
+            if partial:
+                results.append((child.text, "[Partial] " + partial))
+            else:
+                unprocessed.append(child.text)
+        unprocessed += root.skipped
+
+        if budget.stopped_early and not results:
+            yield f"[Status] Budget ran out before any {tree.noun(1)} was processed. Answering directly..."
+            logger.info(f"[{name} Mode] Budget ran out before any {tree.noun(1)} was processed. Responding directly (streaming)...")
+            yield from answer_directly(user_input, history, temperature, top_p, top_k)
+            return
+
+        if (not budget.stopped_early and (tree.root_text is None or is_llm_error(tree.root_text))) or not root.children:
+            reason = "failed" if tree.root_text is None or is_llm_error(tree.root_text) else f"returned no {tree.noun(1)}s"
+            logger.info(f"[{name} Mode] Decomposition {reason} (Level 1): {tree.root_text}.")
+            if fallback is None:
+                yield f"[Status] Decomposition {reason}. Answering directly..."
+                yield from answer_directly(user_input, history, temperature, top_p, top_k)
+            else:
+                yield f"[Status] Level 1 decomposition {reason}. Falling back to {fallback} compute mode..."
+                yield from COMPUTE_LEVELS[fallback](user_input, history, temperature, top_p, top_k)
+            return
+
+        if tree.duplicates:
+            logger.info(f"[{name} Mode] {tree.duplicates} duplicate item(s) were solved once and shared.")
+            yield f"[Status] {tree.duplicates} duplicate {tree.noun(1) if depth == 1 else 'step'}(s) were solved once and their results shared."
+        if unprocessed:
+            yield f"[Status] Budget reached. Synthesizing a partial response from {len(results)} processed {tree.noun(1)}(s)..."
+        elif depth == 1:
+            yield "[Status] All subtasks solved. Synthesizing final response..."
+        else:
+            yield "[Status] All Level 1 stages processed. Synthesizing final response..."
+        results = yield from tree.merge_results(root, results)
+        logger.info(f"[{name} Mode] Synthesizing final response (streaming)...")
+        if depth == 1:
+            final_synthesis_prompt = tree.prefix + 'The task was broken down and the results for each subtask are:\n---\n'
+        else:
+            final_synthesis_prompt = tree.prefix + 'This complex task was addressed in the following major stages, with these results:\n---\n'
+        for i, (title, result) in enumerate(results):
+            final_synthesis_prompt += tree.result_entry(root, i, title, result)
+        if unprocessed:
+            final_synthesis_prompt += f"These {tree.noun(1)}s could not be processed within the compute budget; cover them briefly yourself:\n" + "".join(f"- {item}\n" for item in unprocessed) + "---\n"
+        if depth == 1:
+            final_synthesis_prompt += "Combine these results into a single, coherent, well-formatted final response that directly addresses the original task. Do not just list the subtasks and results; synthesize them."
+        else:
+            final_synthesis_prompt += "Synthesize all these stage results into a comprehensive, well-structured final answer that directly addresses the original complex task. Ensure coherence and clarity."
+
+        final_parts = []
+        for response_part in call_llm(final_synthesis_prompt, temperature=tree.control_temp, top_p=top_p, top_k=top_k, stream=True, kind="synthesis", role="final synthesis", max_tokens=budget.max_tokens_for(estimate_tokens(final_synthesis_prompt)), use_cache=not checkpoint.restored):
+            final_parts.append(response_part)
+            yield response_part
+        final_response = "".join(final_parts)
+        if final_response and not is_llm_error(final_response) and not final_response.startswith("An unexpected error occurred:") and "[Error processing stream chunk:" not in final_response:
+            checkpoint.complete()
+        logger.info(f"[{name} Mode] Final response stream synthesized.")
+
+    tree_compute.__name__ = f"{name.lower()}_compute"
+    return tree_compute
+
+
+medium_compute = make_tree_compute("Medium", [None])
+high_compute = make_tree_compute("High", [None, None], fallback="Medium")
+ultra_compute = make_tree_compute("Ultra", ULTRA_FAN_OUTS, fallback="High")
+
+
+COMPUTE_LEVELS = {
+    "Low": low_compute,
+    "Medium": medium_compute,
+    "High": high_compute,
+    "Ultra": ultra_compute,
+}
+
+
+def run_compute(user_input, compute_level="Low", history=None, temperature=0.7, top_p=1.0, top_k=0, token_budget=None, time_budget=None, synthesis_batch_tokens=None):
+    compute_function = COMPUTE_LEVELS.get(compute_level)
+    if compute_function is None:
+        raise ValueError(f"Unknown computation level: {compute_level}. Expected one of: {', '.join(COMPUTE_LEVELS)}.")
+    started = time.perf_counter()
+    first_token_seconds = None
+    statuses = []
+    response_parts = []
+    trace = RequestTrace(compute_level, user_input)
+    budget = Budget(TOKEN_BUDGET if token_budget is None else token_budget, TIME_BUDGET if time_budget is None else time_budget)
+    for response_part in trace_compute(compute_function, trace, user_input, history or [], temperature, top_p, top_k, budget, synthesis_batch_tokens):
+        if response_part.startswith("[Status]"):
+            statuses.append(response_part)
+        else:
+            if first_token_seconds is None:
+                first_token_seconds = time.perf_counter() - started
+            response_parts.append(response_part)
+    return {
+        "response": "".join(response_parts),
+        "statuses": statuses,
+        "seconds": time.perf_counter() - started,
+        "first_token_seconds": first_token_seconds,
+        "trace": trace.summary(),
+        "budget": budget.report() if budget.limited else None,
+    }
 
-    yield "[Status] All Level 1 stages processed. Synthesizing final response..."
-    print("[High Mode] Synthesizing final response from Level 1 results (streaming)...")
-    final_synthesis_prompt = f'Original complex task: "{user_input}". The task was addressed in the following major stages, with these results:\n---\n'
-    for i, res_l1 in enumerate(subtasks_l1_results):
-        final_synthesis_prompt += f"{i+1}. Stage: {res_l1['subtask']}\n   Overall Result for Stage: {res_l1['result']}\n---\n"
-    final_synthesis_prompt += "Synthesize all these stage results into a comprehensive, well-structured final answer that directly addresses the original complex task. Ensure coherence and clarity."
 
-    full_response = ""
-    for chunk in call_llm(final_synthesis_prompt, temperature=control_temp, top_p=top_p, top_k=top_k, stream=True):
-        full_response += chunk
-        yield full_response
-    print("[High Mode] Final response stream synthesized.")
+def run_batch(input_path, output_path, compute_level="Low", concurrency=1, temperature=0.7, top_p=1.0, top_k=0, token_budget=None, time_budget=None, synthesis_batch_tokens=None):
+    with open(input_path, encoding="utf-8") as f:
+        lines = [line for line in f if line.strip()]
+    logger.info(f"[Batch] Running {len(lines)} prompt(s) from {input_path} (default level {compute_level}, concurrency {concurrency})...")
+
+    def make_job(index, line):
+        def job():
+            result = {"index": index, "id": index, "level": compute_level, "prompt": None}
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("line is not a JSON object")
+                result.update({"id": record.get("id", index), "level": record.get("level", compute_level), "prompt": record.get("prompt")})
+                if not isinstance(result["prompt"], str):
+                    raise ValueError('record has no "prompt" string')
+                result.update(run_compute(result["prompt"], result["level"], record.get("history"), record.get("temperature", temperature), record.get("top_p", top_p), record.get("top_k", top_k), record.get("token_budget", token_budget), record.get("time_budget", time_budget), record.get("synthesis_batch_tokens", synthesis_batch_tokens)))
+                result["error"] = None
+            except Exception as e:
+                logger.error(f"[Batch] Prompt {index} failed: {e}")
+                result.update({"response": "", "statuses": [], "seconds": None, "first_token_seconds": None, "trace": None, "budget": None, "error": str(e)})
+            return result
+        return job
+
+    started = time.perf_counter()
+    completed = 0
+    with open(output_path, "w", encoding="utf-8") as out:
+        for index, result in run_in_parallel([make_job(i, line) for i, line in enumerate(lines)], max_workers=concurrency):
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            completed += 1
+            logger.info(f"[Batch] {completed}/{len(lines)} done (prompt {index}, {result['seconds'] or 0:.1f}s).")
+    total_seconds = time.perf_counter() - started
+    logger.info(f"[Batch] Finished {len(lines)} prompt(s) in {total_seconds:.1f}s. Results written to {output_path}.")
+    scheduler_stats = request_scheduler.stats()
+    for name, stats in scheduler_stats["classes"].items():
+        if stats["granted"]:
+            logger.info(f"[Batch] Scheduler {name}: {stats['granted']} call(s), wait avg {stats['avg_wait_seconds']:.2f}s / p95 {stats['p95_wait_seconds']:.2f}s / max {stats['max_wait_seconds']:.2f}s, peak queue {stats['peak_queued']}.")
+    for level, metrics in level_metrics.snapshot().items():
+        logger.info(f"[Batch] {level}: {metrics['requests']} request(s), {metrics['avg_wall_seconds']:.1f}s and {metrics['avg_llm_calls']:.1f} LLM calls on average, {metrics['prompt_tokens']}+{metrics['completion_tokens']} tokens in total.")
+    return total_seconds
+
+
+class UiStreamBuffer:
+    def __init__(self, frame_rate=UI_FRAME_RATE, flush_bytes=UI_FLUSH_BYTES):
+        self.interval = 1.0 / frame_rate if frame_rate > 0 else 0.0
+        self.flush_bytes = flush_bytes
+        self.text = ""
+        self.pending = []
+        self.pending_bytes = 0
+        self.last_flush = None
+        self.frames = 0
+
+    def add(self, chunk):
+        self.pending.append(chunk)
+        self.pending_bytes += len(chunk)
+        return self.last_flush is None or time.perf_counter() - self.last_flush >= self.interval or 0 < self.flush_bytes <= self.pending_bytes
+
+    def seconds_until_due(self):
+        if not self.pending:
+            return None
+        return max(0.0, self.last_flush + self.interval - time.perf_counter())
+
+    def flush(self):
+        if self.pending:
+            self.text += "".join(self.pending)
+            self.pending = []
+            self.pending_bytes = 0
+        self.last_flush = time.perf_counter()
+        self.frames += 1
+        return self.text
+
+
+def stream_into_history(response_generator, history, current_status):
+    buffer = UiStreamBuffer()
+    response_queue = queue.Queue()
+    cancelled = threading.Event()
+    errors = []
+    finished = object()
+
+    def pump():
+        try:
+            for response_part in response_generator:
+                if cancelled.is_set():
+                    break
+                response_queue.put(response_part)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            response_generator.close()
+            response_queue.put(finished)
+
+    threading.Thread(target=contextvars.copy_context().run, args=(pump,), name="ui-stream", daemon=True).start()
+    try:
+        while True:
+            try:
+                response_part = response_queue.get(timeout=buffer.seconds_until_due())
+            except queue.Empty:
+                history[-1][1] = buffer.flush()
+                yield history, "", current_status
+                continue
+            if response_part is finished:
+                break
+            if isinstance(response_part, str) and response_part.startswith("[Status]"):
+                current_status = response_part
+                history[-1][1] = buffer.flush()
+                yield history, "", current_status
+            elif isinstance(response_part, str):
+                if buffer.add(response_part):
+                    history[-1][1] = buffer.flush()
+                    yield history, "", current_status
+            else:
+                logger.warning(f"Unexpected type yielded from compute function: {type(response_part)}")
+                buffer.add(f"\n[Warning: Unexpected data type in response stream: {type(response_part)}]")
+                history[-1][1] = buffer.flush()
+                yield history, "", current_status
+    finally:
+        cancelled.set()
+    if errors:
+        raise errors[0]
+    history[-1][1] = buffer.flush()
+    logger.debug(f"Streamed {len(buffer.text)} characters to the interface in {buffer.frames} frame(s).")
 
 
-def chat_interface_logic(message, history, compute_level, temperature, top_p, top_k):
+def chat_interface_logic(message, history, compute_level, temperature, top_p, top_k, token_budget=0, time_budget=0, synthesis_batch_tokens=0):
     if history is None:
         history = []
 
     history.append([message, ""])
     yield history, "", "[Status] Processing request..."
 
-    compute_function = None
-    if compute_level == "Low":
-        compute_function = low_compute
-    elif compute_level == "Medium":
-        compute_function = medium_compute
-    elif compute_level == "High":
-        compute_function = high_compute
-    else:
+    compute_function = COMPUTE_LEVELS.get(compute_level)
+    if compute_function is None:
         error_msg = "Error: Unknown computation level selected."
         history[-1][1] = error_msg
         yield history, "", "[Status] Error"
         return
 
-    response_generator = compute_function(message, history[:-1], temperature, top_p, top_k)
+    budget = Budget(token_budget, time_budget)
+    response_generator = trace_compute(compute_function, RequestTrace(compute_level, message), message, history[:-1], temperature, top_p, top_k, budget, int(synthesis_batch_tokens or 0))
 
-    final_assistant_response = ""
     current_status = "[Status] Processing request..."
 
     try:
-        for response_part in response_generator:
-            if isinstance(response_part, str) and response_part.startswith("[Status]"):
-                current_status = response_part
-                yield history, "", current_status
-            elif isinstance(response_part, str):
-                final_assistant_response = response_part
-                history[-1][1] = final_assistant_response
-                yield history, "", current_status
-            else:
-                print(f"Warning: Unexpected type yielded from compute function: {type(response_part)}")
-                error_fragment = f"\n[Warning: Unexpected data type in response stream: {type(response_part)}]"
-                final_assistant_response += error_fragment
-                history[-1][1] = final_assistant_response
-                yield history, "", current_status
-
+        yield from stream_into_history(response_generator, history, current_status)
     except Exception as e:
-        print(f"Error during response generation: {e}")
+        logger.error(f"Error during response generation: {e}")
         error_msg = f"An error occurred during processing: {e}"
         history[-1][1] = error_msg
         yield history, "", "[Status] Error Encountered"
         return
 
-    yield history, "", ""
+    yield history, "", budget.describe() if budget.limited else ""
 
 
-def regenerate_last(history, compute_level, temperature, top_p, top_k):
+def regenerate_last(history, compute_level, temperature, top_p, top_k, token_budget=0, time_budget=0, synthesis_batch_tokens=0):
     if not history:
         yield history, "", "[Status] Cannot regenerate: Chat history is empty."
         return
@@ -383,137 +2407,520 @@ def regenerate_last(history, compute_level, temperature, top_p, top_k):
     history[-1][1] = ""
     yield history, "", f"[Status] Regenerating response for: \"{last_user_message[:50]}...\""
 
-    compute_function = None
-    if compute_level == "Low":
-        compute_function = low_compute
-    elif compute_level == "Medium":
-        compute_function = medium_compute
-    elif compute_level == "High":
-        compute_function = high_compute
-    else:
+    compute_function = COMPUTE_LEVELS.get(compute_level)
+    if compute_function is None:
         error_msg = "Error: Unknown computation level selected."
         history[-1][1] = error_msg
         yield history, "", "[Status] Error"
         return
 
-    response_generator = compute_function(last_user_message, history_context, temperature, top_p, top_k)
+    budget = Budget(token_budget, time_budget)
+    response_generator = trace_compute(compute_function, RequestTrace(compute_level, last_user_message), last_user_message, history_context, temperature, top_p, top_k, budget, int(synthesis_batch_tokens or 0))
 
-    final_assistant_response = ""
     current_status = f"[Status] Regenerating response for: \"{last_user_message[:50]}...\""
 
     try:
-        for response_part in response_generator:
-            if isinstance(response_part, str) and response_part.startswith("[Status]"):
-                current_status = response_part
-                yield history, "", current_status
-            elif isinstance(response_part, str):
-                final_assistant_response = response_part
-                history[-1][1] = final_assistant_response
-                yield history, "", current_status
-            else:
-                print(f"Warning: Unexpected type yielded during regeneration: {type(response_part)}")
-                error_fragment = f"\n[Warning: Unexpected data type in response stream: {type(response_part)}]"
-                final_assistant_response += error_fragment
-                history[-1][1] = final_assistant_response
-                yield history, "", current_status
-
+        yield from stream_into_history(response_generator, history, current_status)
     except Exception as e:
-        print(f"Error during response regeneration: {e}")
+        logger.error(f"Error during response regeneration: {e}")
         error_msg = f"An error occurred during regeneration: {e}"
         history[-1][1] = error_msg
         yield history, "", "[Status] Error Encountered during Regeneration"
         return
 
-    yield history, "", ""
-
+    yield history, "", budget.describe() if budget.limited else ""
 
-with gr.Blocks(theme=gr.themes.Soft()) as demo:
-    gr.Markdown("# Advanced Chat Agent with Computation Levels (Local LLM)")
-    gr.Markdown(f"Using endpoint: `{LOCAL_API_ENDPOINT}` with model `{LLM_MODEL}`")
-    if LLM_API_KEY:
-        gr.Markdown("API Key: Loaded from environment variable.")
-    else:
-        gr.Markdown("API Key: Not configured (using endpoint without Authorization header).")
-
-    with gr.Row():
-        with gr.Column(scale=1):
-            compute_level_selector = gr.Radio(
-                ["Low", "Medium", "High"],
-                label="Computation Level",
-                value="Low",
-                info="Low: Direct response. Medium: 1-level decomposition. High: 2-level decomposition."
-            )
-            temp_slider = gr.Slider(
-                minimum=0.0, maximum=2.0, value=0.7, step=0.1, label="Temperature",
-                info="Controls randomness. Lower values make the model more deterministic."
-            )
-            top_p_slider = gr.Slider(
-                minimum=0.0, maximum=1.0, value=1.0, step=0.05, label="Top-P (Nucleus Sampling)",
-                info="Considers only tokens with cumulative probability >= top_p. 1.0 disables it."
-            )
-            top_k_slider = gr.Slider(
-                minimum=0, maximum=100, value=0, step=1, label="Top-K",
-                info="Considers only the top k most likely tokens. 0 disables it."
-            )
-            with gr.Row():
-                 regenerate_btn = gr.Button("Regenerate")
-                 clear_btn = gr.ClearButton(value="Clear Chat")
-
-
-        with gr.Column(scale=4):
-            status_display = gr.Markdown("", label="Current Status")
-            chatbot = gr.Chatbot(label="Chat", height=700, show_copy_button=True, likeable=True, show_share_button=True)
-            with gr.Row():
-                chat_input = gr.Textbox(
-                    label="Your message",
-                    placeholder="Enter your query here...",
-                    scale=4,
-                    show_label=False,
-                    container=False
-                )
-                submit_btn = gr.Button("Submit", variant="primary", scale=1, min_width=120)
-
-    clear_btn.add(components=[chat_input, chatbot, status_display])
-
-    submit_inputs = [chat_input, chatbot, compute_level_selector, temp_slider, top_p_slider, top_k_slider]
-    submit_outputs = [chatbot, chat_input, status_display]
-
-    regenerate_inputs = [chatbot, compute_level_selector, temp_slider, top_p_slider, top_k_slider]
-    regenerate_outputs = [chatbot, chat_input, status_display]
-
-    submit_btn.click(
-        fn=chat_interface_logic,
-        inputs=submit_inputs,
-        outputs=submit_outputs,
-        queue=True
-    )
-    chat_input.submit(
-         fn=chat_interface_logic,
-        inputs=submit_inputs,
-        outputs=submit_outputs,
-        queue=True
-    )
-    regenerate_btn.click(
-        fn=regenerate_last,
-        inputs=regenerate_inputs,
-        outputs=regenerate_outputs,
-        queue=True
-    )
 
+def build_ui():
+    import gradio as gr
 
-if __name__ == "__main__":
-    print(f"Launching Gradio interface for local LLM...")
-    print(f"Connecting to: {LOCAL_API_ENDPOINT}")
-    print(f"Model name used in requests: {LLM_MODEL}")
+    with gr.Blocks(theme=gr.themes.Soft()) as demo:
+        gr.Markdown("# Advanced Chat Agent with Computation Levels (Local LLM)")
+        gr.Markdown("Using endpoint" + ("s: " if len(get_router().endpoints) > 1 else ": ") + ", ".join(f"`{endpoint.url}` with model `{endpoint.model}`" for endpoint in get_router().endpoints))
+        if LLM_API_KEY:
+            gr.Markdown("API Key: Loaded from environment variable.")
+        else:
+            gr.Markdown("API Key: Not configured (using endpoint without Authorization header).")
+
+        with gr.Row():
+            with gr.Column(scale=1):
+                compute_level_selector = gr.Radio(
+                    list(COMPUTE_LEVELS),
+                    label="Computation Level",
+                    value="Low",
+                    info=f"Low: Direct response. Medium: 1-level decomposition. High: 2-level decomposition. Ultra: {len(ULTRA_FAN_OUTS)}-level decomposition."
+                )
+                temp_slider = gr.Slider(
+                    minimum=0.0, maximum=2.0, value=0.7, step=0.1, label="Temperature",
+                    info="Controls randomness. Lower values make the model more deterministic."
+                )
+                top_p_slider = gr.Slider(
+                    minimum=0.0, maximum=1.0, value=1.0, step=0.05, label="Top-P (Nucleus Sampling)",
+                    info="Considers only tokens with cumulative probability >= top_p. 1.0 disables it."
+                )
+                top_k_slider = gr.Slider(
+                    minimum=0, maximum=100, value=0, step=1, label="Top-K",
+                    info="Considers only the top k most likely tokens. 0 disables it."
+                )
+                token_budget_input = gr.Number(
+                    value=TOKEN_BUDGET, precision=0, minimum=0, label="Token Budget",
+                    info="Max prompt + completion tokens per request. Medium/High adapt fan-out and depth to fit. 0 disables it."
+                )
+                time_budget_input = gr.Number(
+                    value=TIME_BUDGET, minimum=0, label="Time Budget (seconds)",
+                    info="Max wall-clock time per request before synthesizing what is done. 0 disables it."
+                )
+                synthesis_batch_input = gr.Number(
+                    value=SYNTHESIS_BATCH_TOKENS, precision=0, minimum=0, label="Synthesis Batch (tokens)",
+                    info="Max result tokens per synthesis prompt. Larger result sets are merged in parallel groups first. 0 synthesizes everything in one pass."
+                )
+                with gr.Row():
+                     regenerate_btn = gr.Button("Regenerate")
+                     clear_btn = gr.ClearButton(value="Clear Chat")
+
+
+            with gr.Column(scale=4):
+                status_display = gr.Markdown("", label="Current Status")
+                chatbot = gr.Chatbot(label="Chat", height=700, show_copy_button=True, likeable=True, show_share_button=True)
+                with gr.Row():
+                    chat_input = gr.Textbox(
+                        label="Your message",
+                        placeholder="Enter your query here...",
+                        scale=4,
+                        show_label=False,
+                        container=False
+                    )
+                    submit_btn = gr.Button("Submit", variant="primary", scale=1, min_width=120)
+
+        clear_btn.add(components=[chat_input, chatbot, status_display])
+
+        submit_inputs = [chat_input, chatbot, compute_level_selector, temp_slider, top_p_slider, top_k_slider, token_budget_input, time_budget_input, synthesis_batch_input]
+        submit_outputs = [chatbot, chat_input, status_display]
+
+        regenerate_inputs = [chatbot, compute_level_selector, temp_slider, top_p_slider, top_k_slider, token_budget_input, time_budget_input, synthesis_batch_input]
+        regenerate_outputs = [chatbot, chat_input, status_display]
+
+        submit_btn.click(
+            fn=chat_interface_logic,
+            inputs=submit_inputs,
+            outputs=submit_outputs,
+            queue=True
+        )
+        chat_input.submit(
+             fn=chat_interface_logic,
+            inputs=submit_inputs,
+            outputs=submit_outputs,
+            queue=True
+        )
+        regenerate_btn.click(
+            fn=regenerate_last,
+            inputs=regenerate_inputs,
+            outputs=regenerate_outputs,
+            queue=True
+        )
+
+    return demo
+
+
+def launch_ui():
+    logger.info(f"Launching Gradio interface for local LLM...")
     if LLM_API_KEY:
-        print("API Key detected in environment variables.")
+        logger.info("API Key detected in environment variables.")
     else:
-        print("API Key not found in environment variables.")
+        logger.info("API Key not found in environment variables.")
+    router = get_router()
+    for endpoint, healthy in zip(router.endpoints, router.check_all()):
+        if healthy:
+            logger.info(f"Endpoint {endpoint.url} is accessible (model '{endpoint.model}').")
+        else:
+            logger.warning(f"Could not reach endpoint {endpoint.url}: {endpoint.last_error}")
+    router.start_health_checks()
+
+    if request_scheduler.max_in_flight:
+        logger.info(f"Request scheduler: at most {request_scheduler.max_in_flight} LLM calls in flight, {request_scheduler.interactive_reserve} reserved for interactive calls.")
+    build_ui().queue(default_concurrency_limit=UI_CONCURRENCY or None).launch()
+
+
+def message_text(content):
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict) and part.get("type", "text") == "text")
+    return content or ""
+
+
+def split_messages(messages):
+    if not isinstance(messages, list) or not messages:
+        raise ValueError("'messages' must be a non-empty list.")
+    system = [message_text(message.get("content")) for message in messages if message.get("role") in ("system", "developer")]
+    turns = [message for message in messages if message.get("role") in ("user", "assistant")]
+    if not turns or turns[-1].get("role") != "user":
+        raise ValueError("The last message must be a user message.")
+    history = []
+    for message in turns[:-1]:
+        text = message_text(message.get("content"))
+        if message["role"] == "user":
+            history.append([text, ""])
+        elif history and not history[-1][1]:
+            history[-1][1] = text
+        else:
+            history.append(["", text])
+    user_input = "\n\n".join(system + [message_text(turns[-1].get("content"))])
+    return user_input, history
+
+
+def level_for_model(model, default=SERVER_DEFAULT_LEVEL):
+    model = (model or "").lower()
+    for level in COMPUTE_LEVELS:
+        if model == level.lower() or model.endswith("-" + level.lower()):
+            return level
+    return default
+
+
+async def acompute(compute_function, trace, user_input, history, temperature, top_p, top_k, budget=None, synthesis_batch_tokens=None, executor=None):
+    loop = asyncio.get_running_loop()
+    response_queue = asyncio.Queue()
+    cancelled = threading.Event()
+    lock = threading.Lock()
+    pending = []
+    finished = object()
+
+    def deliver():
+        nonlocal pending
+        with lock:
+            response_parts, pending = pending, []
+        response_queue.put_nowait(response_parts)
+
+    def put(item):
+        with lock:
+            pending.append(item)
+            if len(pending) > 1:
+                return
+        try:
+            loop.call_soon_threadsafe(deliver)
+        except RuntimeError:
+            cancelled.set()
+
+    def pump():
+        response_parts = trace_compute(compute_function, trace, user_input, history, temperature, top_p, top_k, budget, synthesis_batch_tokens)
+        try:
+            for response_part in response_parts:
+                if cancelled.is_set():
+                    break
+                put(response_part)
+        except Exception as e:
+            put(e)
+        finally:
+            response_parts.close()
+            put(finished)
+
+    loop.run_in_executor(executor, contextvars.copy_context().run, pump)
     try:
-        base_url = '/'.join(LOCAL_API_ENDPOINT.split('/')[:3])
-        response = requests.get(base_url, timeout=5)
-        print(f"Base URL {base_url} is accessible (Status: {response.status_code}).")
-    except Exception as e:
-        print(f"Warning: Could not check endpoint base URL accessibility ({base_url}): {e}")
+        while True:
+            response_parts = await response_queue.get()
+            done = response_parts[-1] is finished
+            if done:
+                response_parts = response_parts[:-1]
+            for index, response_part in enumerate(response_parts):
+                if isinstance(response_part, Exception):
+                    if index:
+                        yield response_parts[:index]
+                    raise response_part
+            if response_parts:
+                yield response_parts
+            if done:
+                break
+    finally:
+        cancelled.set()
+
+
+class ApiServer:
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS, api_key=SERVER_API_KEY, default_level=SERVER_DEFAULT_LEVEL):
+        if default_level not in COMPUTE_LEVELS:
+            raise ValueError(f"Unknown computation level: {default_level}. Expected one of: {', '.join(COMPUTE_LEVELS)}.")
+        self.host = host
+        self.port = port
+        self.api_key = api_key
+        self.default_level = default_level
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="api-worker")
+        self.ready = threading.Event()
+        self.loop = None
+        self.server = None
+        self.requests = 0
+        self.active = 0
+        self.peak_active = 0
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/v1/chat/completions"
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"[Server] Serving OpenAI-compatible chat completions at {self.url} (default level {self.default_level}, {self.workers} compute workers).")
+        self.ready.set()
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+                keep_alive = await self.dispatch(method, path.split("?", 1)[0], headers, body, reader, writer)
+                if keep_alive is False or version.strip() != "HTTP/1.1" or headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def send_json(self, writer, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        reason = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 500: "Internal Server Error"}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+
+    async def send_error(self, writer, status, message, error_type="invalid_request_error"):
+        await self.send_json(writer, status, {"error": {"message": message, "type": error_type, "code": None}})
+
+    @staticmethod
+    def sse_event(data, event=None):
+        return (f"event: {event}\n" if event else "") + f"data: {data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)}\n\n"
+
+    async def send_events(self, writer, events):
+        if events:
+            payload = "".join(events).encode("utf-8")
+            writer.write(b"%x\r\n%s\r\n" % (len(payload), payload))
+            await writer.drain()
+
+    async def dispatch(self, method, path, headers, body, reader, writer):
+        if self.api_key and headers.get("authorization") != f"Bearer {self.api_key}":
+            await self.send_error(writer, 401, "Invalid or missing API key.", "authentication_error")
+        elif method == "GET" and path == "/v1/models":
+            await self.send_json(writer, 200, {"object": "list", "data": [{"id": f"{SERVER_MODEL_PREFIX}-{level.lower()}", "object": "model", "owned_by": SERVER_MODEL_PREFIX} for level in COMPUTE_LEVELS]})
+        elif method == "POST" and path == "/v1/chat/completions":
+            return await self.chat_completions(body, reader, writer)
+        else:
+            await self.send_error(writer, 404, f"No route for {method} {path}.")
+
+    async def chat_completions(self, body, reader, writer):
+        def option(name, default, convert):
+            value = request.get(name)
+            if value is None:
+                return default
+            if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+                raise TypeError(f"'{name}' must be a number, got {json.dumps(value)}")
+            try:
+                value = convert(value)
+            except ValueError:
+                raise ValueError(f"'{name}' must be a number, got {json.dumps(value)}") from None
+            if not math.isfinite(value):
+                raise ValueError(f"'{name}' must be a finite number, got {json.dumps(str(value))}")
+            return value
+
+        def flag(name):
+            value = request.get(name)
+            if value is not None and not isinstance(value, bool):
+                raise TypeError(f"'{name}' must be a boolean, got {json.dumps(value)}")
+            return bool(value)
+
+        try:
+            request = json.loads(body)
+            user_input, history = split_messages(request.get("messages"))
+            model = request.get("model")
+            if model is not None and not isinstance(model, str):
+                raise TypeError(f"'model' must be a string, got {json.dumps(model)}")
+            level = request.get("compute_level") or level_for_model(model, self.default_level)
+            if not isinstance(level, str):
+                raise TypeError(f"'compute_level' must be a string, got {json.dumps(level)}")
+            level = {name.lower(): name for name in COMPUTE_LEVELS}.get(level.lower(), level)
+            stream = flag("stream")
+            include_status = flag("include_status")
+            stream_options = request.get("stream_options") or {}
+            if not isinstance(stream_options, dict):
+                raise TypeError(f"'stream_options' must be an object, got {json.dumps(stream_options)}")
+            include_usage = stream_options.get("include_usage")
+            if include_usage is not None and not isinstance(include_usage, bool):
+                raise TypeError(f"'stream_options.include_usage' must be a boolean, got {json.dumps(include_usage)}")
+            temperature = option("temperature", 0.7, float)
+            top_p = option("top_p", 1.0, float)
+            top_k = option("top_k", 0, int)
+            token_budget = option("token_budget", TOKEN_BUDGET, int)
+            time_budget = option("time_budget", TIME_BUDGET, float)
+            synthesis_batch_tokens = option("synthesis_batch_tokens", None, int)
+        except (ValueError, AttributeError, TypeError) as e:
+            await self.send_error(writer, 400, f"Invalid request: {e}")
+            return
+        if level not in COMPUTE_LEVELS:
+            await self.send_error(writer, 400, f"Unknown computation level: {level}. Expected one of: {', '.join(COMPUTE_LEVELS)}.")
+            return
+        model = model or f"{SERVER_MODEL_PREFIX}-{level.lower()}"
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        trace = RequestTrace(level, user_input)
+        budget = Budget(token_budget, time_budget)
+        response_parts = acompute(COMPUTE_LEVELS[level], trace, user_input, history, temperature, top_p, top_k, budget, synthesis_batch_tokens, self.executor)
+        self.requests += 1
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+        task = asyncio.current_task()
+        disconnected = False
+        finished = False
+
+        async def watch_disconnect():
+            nonlocal disconnected
+            try:
+                data = await reader.read(1)
+            except ConnectionError:
+                data = b""
+            if not data and not finished:
+                disconnected = True
+                task.cancel()
+            return data
+
+        watcher = asyncio.create_task(watch_disconnect())
+        try:
+            if stream:
+                await self.stream_completion(writer, response_parts, trace, completion_id, created, model, include_status, include_usage)
+            else:
+                statuses = []
+                answer = []
+                async for batch in response_parts:
+                    for response_part in batch:
+                        (statuses if response_part.startswith("[Status]") else answer).append(response_part)
+                summary = trace.summary()
+                response = {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(answer)}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": summary["prompt_tokens"], "completion_tokens": summary["completion_tokens"], "total_tokens": summary["prompt_tokens"] + summary["completion_tokens"]},
+                }
+                if include_status:
+                    response["statuses"] = statuses
+                await self.send_json(writer, 200, response)
+        except asyncio.CancelledError:
+            if not disconnected:
+                raise
+            logger.info(f"[Server] Client disconnected from {completion_id}; stopping its computation.")
+            raise ConnectionError(f"client disconnected from {completion_id}") from None
+        except ConnectionError:
+            logger.info(f"[Server] Client disconnected from {completion_id}; stopping its computation.")
+            raise
+        except Exception as e:
+            logger.error(f"[Server] Error while computing {completion_id}: {e}")
+            await self.send_error(writer, 500, f"An error occurred during processing: {e}", "server_error")
+        finally:
+            finished = True
+            self.active -= 1
+            watcher.cancel()
+            await asyncio.wait([watcher])
+            await response_parts.aclose()
+        # A pipelined request started arriving while this one was computed; its first byte is gone, so close.
+        return watcher.cancelled()
+
+    async def stream_completion(self, writer, response_parts, trace, completion_id, created, model, include_status, include_usage):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nTransfer-Encoding: chunked\r\n\r\n")
+
+        def chunk(delta, finish_reason=None):
+            return {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+        def error_event(e):
+            return self.sse_event({"error": {"message": f"An error occurred during processing: {e}", "type": "server_error", "code": None}})
+
+        try:
+            await self.send_events(writer, [self.sse_event(chunk({"role": "assistant", "content": ""}))])
+            try:
+                async for batch in response_parts:
+                    events = []
+                    for response_part in batch:
+                        if not response_part.startswith("[Status]"):
+                            events.append(self.sse_event(chunk({"content": response_part})))
+                        elif include_status:
+                            events.append(self.sse_event({"id": completion_id, "status": response_part}, event="status"))
+                    await self.send_events(writer, events)
+            except ConnectionError:
+                raise
+            except Exception as e:
+                logger.error(f"[Server] Error while streaming {completion_id}: {e}")
+                await self.send_events(writer, [error_event(e)])
+            events = [self.sse_event(chunk({}, "stop"))]
+            if include_usage:
+                summary = trace.summary()
+                events.append(self.sse_event({"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model, "choices": [], "usage": {"prompt_tokens": summary["prompt_tokens"], "completion_tokens": summary["completion_tokens"], "total_tokens": summary["prompt_tokens"] + summary["completion_tokens"]}}))
+            events.append(self.sse_event("[DONE]"))
+            await self.send_events(writer, events)
+        except ConnectionError:
+            raise
+        except Exception as e:
+            # The status line is already sent, so errors must end the event stream rather than become a 500 response.
+            logger.error(f"[Server] Error while finishing stream {completion_id}: {e}")
+            await self.send_events(writer, [error_event(e), self.sse_event("[DONE]")])
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+def run_api_server(host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS, default_level=SERVER_DEFAULT_LEVEL):
+    get_router().start_health_checks()
+    if request_scheduler.max_in_flight:
+        logger.info(f"Request scheduler: at most {request_scheduler.max_in_flight} LLM calls in flight, {request_scheduler.interactive_reserve} reserved for interactive calls.")
+    try:
+        asyncio.run(ApiServer(host, port, workers, default_level=default_level).serve())
+    except KeyboardInterrupt:
+        logger.info("[Server] Stopped.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat agent with computation levels for OpenAI-compatible LLM endpoints.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("ui", help="Launch the Gradio web interface (default).")
+    batch_parser = subparsers.add_parser("batch", help="Run prompts from a JSONL file without the web interface.")
+    batch_parser.add_argument("input", help='JSONL file with one {"prompt": ...} object per line. Optional per-line keys: id, level, history, temperature, top_p, top_k, token_budget, time_budget, synthesis_batch_tokens.')
+    batch_parser.add_argument("output", help="JSONL file to write responses and timings to.")
+    batch_parser.add_argument("--level", default="Low", choices=list(COMPUTE_LEVELS), help="Default computation level.")
+    batch_parser.add_argument("--concurrency", type=int, default=1, help="How many prompts to run at the same time.")
+    batch_parser.add_argument("--temperature", type=float, default=0.7)
+    batch_parser.add_argument("--top-p", type=float, default=1.0)
+    batch_parser.add_argument("--top-k", type=int, default=0)
+    batch_parser.add_argument("--token-budget", type=int, default=None, help="Max tokens per prompt (default: LLM_TOKEN_BUDGET).")
+    batch_parser.add_argument("--time-budget", type=float, default=None, help="Max seconds per prompt (default: LLM_TIME_BUDGET).")
+    batch_parser.add_argument("--synthesis-batch-tokens", type=int, default=None, help="Max result tokens per synthesis prompt before results are merged in groups; 0 disables merging (default: LLM_SYNTHESIS_BATCH_TOKENS).")
+    serve_parser = subparsers.add_parser("serve", help="Serve the computation levels as an OpenAI-compatible /v1/chat/completions API.")
+    serve_parser.add_argument("--host", default=SERVER_HOST, help="Interface to listen on (default: LLM_SERVER_HOST).")
+    serve_parser.add_argument("--port", type=int, default=SERVER_PORT, help="Port to listen on (default: LLM_SERVER_PORT).")
+    serve_parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="Requests computed at the same time; later ones wait without a thread (default: LLM_SERVER_WORKERS).")
+    serve_parser.add_argument("--default-level", default=SERVER_DEFAULT_LEVEL, choices=list(COMPUTE_LEVELS), help="Level for model names that do not name one (default: LLM_SERVER_DEFAULT_LEVEL).")
+    args = parser.parse_args()
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s [%(threadName)s] %(message)s")
+
+    if args.command == "serve":
+        run_api_server(args.host, args.port, args.workers, args.default_level)
+    elif args.command == "batch":
+        run_batch(args.input, args.output, args.level, args.concurrency, args.temperature, args.top_p, args.top_k, args.token_budget, args.time_budget, args.synthesis_batch_tokens)
+    else:
+        launch_ui()
+
 
-    demo.launch()
+if __name__ == "__main__":
+    main()